@@ -1,5 +1,7 @@
 from .bitmex import BitMEXClient
-from .models import Trade, OpenOrder, OpenOrders
+from .accounts import MultiAccountClient
+from .models import Trade, OpenOrder, OpenOrders, Bar
+from .bars import BarAggregator
 from .rest import RestClientError
 
 __copyright__ = 'Copyright (C) 2019 Weidenthal Research Institute LLC'
@@ -9,4 +11,4 @@ __author__ = 'YANAGISAWA, Kentaro'
 __author_email__ = 'yanagisawa.kentaro@weidenthal.co.jp'
 __url__ = 'https://github.com/yanagisawa-kentaro-777/pybitmex'
 
-__all__ = ["BitMEXClient", "Trade", "OpenOrder", "OpenOrders", "RestClientError"]
+__all__ = ["BitMEXClient", "MultiAccountClient", "Trade", "OpenOrder", "OpenOrders", "Bar", "BarAggregator", "RestClientError"]
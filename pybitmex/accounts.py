@@ -0,0 +1,94 @@
+import logging
+
+from pybitmex import ws, transport
+from pybitmex.bitmex import BitMEXClient
+
+
+# Several accounts trading one symbol, over one public market data feed.
+#
+# A single unauthenticated websocket subscribes to the public tables. Each account gets its own
+# BitMEXClient, whose websocket only subscribes to the private tables and whose RestClient signs
+# with the account's key. The public accessors of every account read the shared feed, so the
+# order book and trades are received, parsed and stored once however many accounts there are.
+class MultiAccountClient:
+
+    def __init__(
+            self,
+            credentials,
+            uri="https://testnet.bitmex.com/api/v1/",
+            symbol="XBTUSD",
+            public_subscriptions=None,
+            private_subscriptions=None,
+            ws_dense_order_book=False,
+            ws_compression=False,
+            **kwargs
+    ):
+        """
+        credentials: dict of account name to (api_key, api_secret).
+        public_subscriptions: the public tables of the shared feed. Defaults to instrument, orderBookL2, quote and trade.
+        private_subscriptions: the private tables of each account. Defaults to all of them.
+        Other keyword arguments are passed to the BitMEXClient of each account.
+        """
+        self.logger = logging.getLogger(__name__)
+
+        self.uri = uri
+        self.symbol = symbol
+
+        if public_subscriptions is None:
+            public_subscriptions = ["instrument", "orderBookL2", "quote", "trade"]
+        self.public_ws_client = ws.BitMEXWebSocketClient(
+            endpoint=uri,
+            symbol=symbol,
+            subscriptions=[t for t in public_subscriptions if t in ws.PUBLIC_TABLES],
+            dense_order_book=ws_dense_order_book,
+            transport=transport.DeflateTransport() if ws_compression else transport.WebSocketAppTransport()
+        )
+
+        self.clients = {}
+        try:
+            for name, (api_key, api_secret) in credentials.items():
+                self.add_account(name, api_key, api_secret,
+                                 private_subscriptions=private_subscriptions, ws_compression=ws_compression, **kwargs)
+        except Exception:
+            self.close()
+            raise
+
+    def add_account(self, name, api_key, api_secret, private_subscriptions=None, **kwargs):
+        """Connect another account to the shared feed and return its client."""
+        if name in self.clients:
+            raise ValueError("Account %s already exists." % name)
+        client = BitMEXClient(
+            uri=self.uri,
+            symbol=self.symbol,
+            api_key=api_key,
+            api_secret=api_secret,
+            subscriptions=private_subscriptions,
+            public_ws_client=self.public_ws_client,
+            **kwargs
+        )
+        self.clients[name] = client
+        return client
+
+    def remove_account(self, name):
+        self.clients.pop(name).close()
+
+    def account(self, name):
+        return self.clients[name]
+
+    def account_names(self):
+        return list(self.clients.keys())
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
+        self.clients = {}
+        self.public_ws_client.exit()
+
+    def __getitem__(self, name):
+        return self.clients[name]
+
+    def __iter__(self):
+        return iter(self.clients.items())
+
+    def __len__(self):
+        return len(self.clients)
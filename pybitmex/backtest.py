@@ -0,0 +1,518 @@
+import json
+import logging
+import time
+import urllib.parse
+import uuid
+from datetime import datetime, timezone
+
+from pybitmex.rest import RestClientError
+from pybitmex.tracker import PositionTracker
+from pybitmex.transport import TransportStats
+from pybitmex.ws import PUBLIC_TABLES, PRIVATE_TABLES
+
+
+# Runs a BitMEXClient against a recorded feed, as fast as the CPU allows.
+#
+# A recording is a file of JSON lines {"time": epoch seconds, "message": websocket message}, as written
+# by FeedRecorder. ReplayTransport plays it into the websocket client in place of a socket, and moves
+# a SimulatedClock to the time of each message. SimulatedRestClient stands in for the RestClient:
+# it rests the orders placed, fills them when the recorded trades print through their price,
+# and sends the resulting order, execution, position and margin messages back through the transport.
+# Everything runs on the thread calling BacktestDriver.run(), so the strategy sees the state
+# of the tables exactly as of each replayed message.
+
+
+class SimulatedClock:
+
+    def __init__(self, start_seconds=0.0):
+        self.time_seconds = start_seconds
+
+    def time(self):
+        return self.time_seconds
+
+    def now(self):
+        return datetime.fromtimestamp(self.time_seconds, timezone.utc)
+
+    def timestamp(self):
+        '''The time in the format of BitMEX timestamps.'''
+        return self.now().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+    def advance_to(self, time_seconds):
+        if self.time_seconds < time_seconds:
+            self.time_seconds = time_seconds
+
+
+def read_recording(path):
+    '''Yield the (time, message) pairs of a recording, messages parsed.'''
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entry = json.loads(line)
+                yield entry['time'], entry['message']
+
+
+class FeedRecorder:
+
+    '''Records the public tables of a websocket client, starting with a partial of what they hold now.'''
+
+    def __init__(self, ws_client, path, tables=None):
+        self.ws_client = ws_client
+        self.tables = [t for t in (tables if tables is not None else ws_client.subscription_list) if t in PUBLIC_TABLES]
+        self.file = open(path, 'w')
+
+        order_book_table = ws_client.get_order_book_table_name()
+        for table in self.tables:
+            if table not in ws_client.data:
+                continue
+            rows = ws_client.market_depth() if table == order_book_table else list(ws_client.data[table])
+            self.__write({'table': table, 'action': 'partial', 'keys': ws_client.keys.get(table, []), 'data': rows})
+        for table in self.tables:
+            ws_client.add_listener(table, self.on_message)
+
+    def on_message(self, table, action, rows):
+        if action == 'partial':
+            self.__write({'table': table, 'action': action, 'keys': self.ws_client.keys.get(table, []), 'data': rows})
+        else:
+            self.__write({'table': table, 'action': action, 'data': rows})
+
+    def close(self):
+        for table in self.tables:
+            self.ws_client.remove_listener(table, self.on_message)
+        self.file.close()
+
+    def __write(self, message):
+        # default=dict serializes compact rows.
+        self.file.write(json.dumps({'time': time.time(), 'message': message}, separators=(',', ':'), default=dict))
+        self.file.write('\n')
+
+
+class SimulatedRestClient:
+
+    '''
+    Matching engine with the order methods of RestClient.
+    Limit orders fill at their price when a recorded trade prints through it (or at it, with fill_on_touch),
+    up to the size of the trade. Market orders and crossing limit orders fill at once at the best opposite quote.
+    Post-only orders that would cross are canceled. Fees are fractions of the order value, negative for rebates.
+    '''
+
+    ACCOUNT = 0
+
+    def __init__(self, symbol, clock, initial_balance=100000000, maker_fee=-0.00025, taker_fee=0.00075,
+                 fill_on_touch=False, order_id_prefix=""):
+        self.logger = logging.getLogger(__name__)
+
+        self.symbol = symbol
+        self.clock = clock
+        self.initial_balance = initial_balance
+        self.maker_fee = maker_fee
+        self.taker_fee = taker_fee
+        self.fill_on_touch = fill_on_touch
+        self.order_id_prefix = order_id_prefix
+
+        # Contract terms are taken from the instrument table as it is replayed.
+        self.tracker = PositionTracker(symbol, reconcile_interval_seconds=float('inf'), clock=clock.time)
+        self.bid = None
+        self.ask = None
+        self.last = None
+
+        # orderID -> order row, of the open orders.
+        self.open_orders = {}
+        self.order_count = 0
+        # Messages for the websocket client, sent by the transport.
+        self.outbox = []
+
+    def close(self):
+        pass
+
+    def get_connection_stats(self):
+        return {}
+
+    def new_client_order_id(self):
+        return self.order_id_prefix + uuid.uuid4().hex
+
+    #
+    # RestClient methods
+    #
+
+    def place_orders(self, orders, post_only=True, max_retries=None):
+        result = []
+        for order in orders:
+            if order.get('clOrdID') is None:
+                order['clOrdID'] = self.new_client_order_id()
+            order['symbol'] = self.symbol
+            if post_only:
+                order['execInst'] = 'ParticipateDoNotInitiate'
+            result.append(self.__place(order))
+        return result
+
+    def market_close_position(self, order, max_retries=None):
+        qty = self.tracker.current_qty
+        if qty == 0:
+            return None
+        order = dict(order, side='Sell' if 0 < qty else 'Buy', orderQty=abs(qty), ordType='Market', execInst='Close')
+        if order.get('clOrdID') is None:
+            order['clOrdID'] = self.new_client_order_id()
+        order['symbol'] = self.symbol
+        return self.__place(order)
+
+    def cancel_orders(self, order_id_list, max_retries=None):
+        result = []
+        for order_id in order_id_list:
+            order = self.open_orders.pop(order_id, None)
+            if order is None:
+                continue
+            order.update(ordStatus='Canceled', leavesQty=0, timestamp=self.clock.timestamp())
+            self.__send('order', 'update', self.__order_update(order))
+            self.__send('execution', 'insert', self.__execution(order, 'Canceled'))
+            result.append(dict(order))
+        return result
+
+    def cancel_orders_by_client_order_id(self, client_order_id_list, max_retries=None):
+        order_ids = [o['orderID'] for o in self.open_orders.values() if o['clOrdID'] in client_order_id_list]
+        return self.cancel_orders(order_ids, max_retries=max_retries)
+
+    def get_user_margin(self):
+        return self.__margin_row()
+
+    def get_positions_of_account(self, filter_json_obj=None, count=500):
+        return [self.__position_row()]
+
+    #
+    # Feed side
+    #
+
+    def private_partials(self, tables):
+        '''The partials of the private tables, as sent on subscription.'''
+        partials = {
+            'execution': {'table': 'execution', 'action': 'partial', 'keys': ['execID'], 'data': []},
+            'order': {'table': 'order', 'action': 'partial', 'keys': ['orderID'],
+                      'data': [dict(o) for o in self.open_orders.values()]},
+            'position': {'table': 'position', 'action': 'partial', 'keys': ['account', 'symbol', 'currency'],
+                         'data': [self.__position_row()]},
+            'margin': {'table': 'margin', 'action': 'partial', 'keys': ['account', 'currency'],
+                       'data': [self.__margin_row()]},
+        }
+        return [partials[t] for t in tables if t in partials]
+
+    def on_market_message(self, message):
+        '''Follow the replayed public tables, filling resting orders against trades.'''
+        table = message.get('table')
+        if table == 'quote':
+            for row in message.get('data', []):
+                if row.get('symbol') == self.symbol:
+                    self.bid = row.get('bidPrice')
+                    self.ask = row.get('askPrice')
+        elif table == 'trade':
+            if message.get('action') == 'partial':
+                return
+            for row in message.get('data', []):
+                if row.get('symbol') == self.symbol:
+                    self.last = row['price']
+                    self.__match_trade(row['price'], row['size'])
+        elif table == 'instrument':
+            for row in message.get('data', []):
+                if row.get('symbol') != self.symbol:
+                    continue
+                if row.get('isInverse') is not None:
+                    self.tracker.is_inverse = row['isInverse']
+                if row.get('multiplier') is not None:
+                    self.tracker.multiplier = row['multiplier']
+                if row.get('markPrice') is not None:
+                    self.tracker.mark_price = float(row['markPrice'])
+
+    def drain(self):
+        '''Take the messages to send to the websocket client.'''
+        outbox = self.outbox
+        self.outbox = []
+        return outbox
+
+    def summary(self):
+        result = self.tracker.to_dict()
+        result['walletBalance'] = self.__wallet_balance()
+        result['openOrders'] = len(self.open_orders)
+        result['orders'] = self.order_count
+        return result
+
+    def __place(self, order):
+        self.order_count += 1
+        ord_type = order.get('ordType') or ('Limit' if order.get('price') is not None else 'Market')
+        row = {
+            'orderID': str(uuid.uuid4()),
+            'clOrdID': order['clOrdID'],
+            'account': SimulatedRestClient.ACCOUNT,
+            'symbol': self.symbol,
+            'side': order['side'],
+            'orderQty': order['orderQty'],
+            'price': order.get('price'),
+            'ordType': ord_type,
+            'execInst': order.get('execInst', ''),
+            'ordStatus': 'New',
+            'leavesQty': order['orderQty'],
+            'cumQty': 0,
+            'avgPx': None,
+            'text': '',
+            'timestamp': self.clock.timestamp()
+        }
+        is_buy = row['side'] == 'Buy'
+        touch = self.ask if is_buy else self.bid
+        if touch is None:
+            touch = self.last
+        crosses = ord_type == 'Market' or (touch is not None and (row['price'] >= touch if is_buy else row['price'] <= touch))
+
+        if crosses and 'ParticipateDoNotInitiate' in row['execInst']:
+            row.update(ordStatus='Canceled', leavesQty=0,
+                       text='Canceled: Order had execInst of ParticipateDoNotInitiate')
+            self.__send('execution', 'insert', self.__execution(row, 'Canceled'))
+            return dict(row)
+        if crosses and touch is None:
+            raise RestClientError("No market price to fill the order at.", 400)
+
+        self.__send('order', 'insert', dict(row))
+        self.__send('execution', 'insert', self.__execution(row, 'New'))
+        if crosses:
+            self.__fill(row, row['leavesQty'], touch, self.taker_fee, 'RemovedLiquidity')
+        else:
+            self.open_orders[row['orderID']] = row
+        return dict(row)
+
+    def __match_trade(self, price, size):
+        remaining = size
+        # Best priced first, then the oldest.
+        candidates = []
+        for order in self.open_orders.values():
+            if order['side'] == 'Buy':
+                through = price < order['price'] or (self.fill_on_touch and price == order['price'])
+                priority = -order['price']
+            else:
+                through = order['price'] < price or (self.fill_on_touch and price == order['price'])
+                priority = order['price']
+            if through:
+                candidates.append((priority, order['timestamp'], order))
+        for _, _, order in sorted(candidates, key=lambda c: (c[0], c[1])):
+            if remaining <= 0:
+                break
+            qty = min(order['leavesQty'], remaining)
+            remaining -= qty
+            self.__fill(order, qty, order['price'], self.maker_fee, 'AddedLiquidity')
+
+    def __fill(self, order, qty, price, fee, liquidity):
+        value = self.tracker.value(qty if order['side'] == 'Buy' else -qty, price)
+        commission = round(fee * abs(value))
+        self.tracker.apply_fill(order['side'], qty, price, commission)
+
+        cum_qty = order['cumQty'] + qty
+        avg_px = price if order['avgPx'] is None else (order['avgPx'] * order['cumQty'] + price * qty) / cum_qty
+        order.update(cumQty=cum_qty, leavesQty=order['leavesQty'] - qty, avgPx=avg_px,
+                     ordStatus='Filled' if order['leavesQty'] == qty else 'PartiallyFilled',
+                     timestamp=self.clock.timestamp())
+        if order['leavesQty'] == 0:
+            self.open_orders.pop(order['orderID'], None)
+
+        execution = self.__execution(order, 'Trade')
+        execution.update(lastQty=qty, lastPx=price, lastLiquidityInd=liquidity, commission=fee,
+                         execCost=round(value), execComm=commission)
+        self.__send('execution', 'insert', execution)
+        self.__send('order', 'update', self.__order_update(order))
+        self.__send('position', 'update', self.__position_row())
+        self.__send('margin', 'update', self.__margin_row())
+
+    def __execution(self, order, exec_type):
+        execution = dict(order)
+        execution.update(execID=str(uuid.uuid4()), execType=exec_type, lastQty=0, lastPx=None,
+                         execCost=0, execComm=0, transactTime=self.clock.timestamp(), timestamp=self.clock.timestamp())
+        return execution
+
+    @staticmethod
+    def __order_update(order):
+        return {k: order[k] for k in ('orderID', 'clOrdID', 'ordStatus', 'leavesQty', 'cumQty', 'avgPx', 'timestamp')}
+
+    def __position_row(self):
+        return {
+            'account': SimulatedRestClient.ACCOUNT,
+            'symbol': self.symbol,
+            'currency': 'XBt',
+            'currentQty': self.tracker.current_qty,
+            'avgEntryPrice': self.tracker.avg_entry_price(),
+            'markPrice': self.tracker.mark_price,
+            'realisedPnl': self.tracker.realised_pnl - self.tracker.commission,
+            'unrealisedPnl': self.tracker.unrealised_pnl(),
+            'timestamp': self.clock.timestamp()
+        }
+
+    def __wallet_balance(self):
+        return self.initial_balance + self.tracker.realised_pnl - self.tracker.commission
+
+    def __margin_row(self):
+        # No margin is set aside for positions and orders.
+        wallet_balance = self.__wallet_balance()
+        return {
+            'account': SimulatedRestClient.ACCOUNT,
+            'currency': 'XBt',
+            'walletBalance': wallet_balance,
+            'withdrawableMargin': wallet_balance,
+            'timestamp': self.clock.timestamp()
+        }
+
+    def __send(self, table, action, row):
+        self.outbox.append({'table': table, 'action': action, 'data': [row]})
+
+
+class ReplayTransport:
+
+    '''
+    Transport playing a recording into BitMEXWebSocketClient, one message per step().
+    Connecting plays the recording up to the partials of the public tables subscribed,
+    and sends the partials of the private tables from the simulated exchange.
+    Use the websocket client with batched_ingest=False, so that each message is applied before step() returns.
+    '''
+
+    def __init__(self, recording, exchange=None, clock=None):
+        '''
+        recording is an iterable of (time, message) pairs, e.g. read_recording(path).
+        Messages may be raw or parsed. They are passed on to the websocket client parsed.
+        '''
+        self.logger = logging.getLogger(__name__)
+        self.stats = TransportStats()
+        self.recording = iter(recording)
+        self.exchange = exchange
+        self.clock = clock
+        self.tables = set()
+        self.connected = False
+        self.on_message = None
+
+    def connect(self, url, header, on_message, on_open, on_close, on_error):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+        topics = query.get('subscribe', [''])[0].split(',')
+        self.tables = set(topic.split(':')[0] for topic in topics if topic)
+        self.on_message = on_message
+        self.on_close = on_close
+        self.connected = True
+        on_open()
+
+        self.__send_private_partials(self.tables)
+        waiting = set(t for t in self.tables if t in PUBLIC_TABLES)
+        while waiting:
+            message = self.step()
+            if message is None:
+                raise ValueError("The recording has no partial of %s." % ', '.join(sorted(waiting)))
+            if message.get('action') == 'partial':
+                waiting.discard(message.get('table'))
+
+    def send(self, text):
+        command = json.loads(text)
+        tables = set(topic.split(':')[0] for topic in command.get('args', []))
+        if command.get('op') == 'subscribe':
+            self.tables |= tables
+            self.__send_private_partials(tables)
+        elif command.get('op') == 'unsubscribe':
+            self.tables -= tables
+
+    def close(self):
+        if self.connected:
+            self.connected = False
+            self.on_close()
+
+    def step(self):
+        '''Play the next message of the recording. Returns it, or None at the end of the recording.'''
+        entry = next(self.recording, None)
+        if entry is None:
+            return None
+        time_seconds, message = entry
+        if self.clock is not None:
+            self.clock.advance_to(time_seconds)
+        if not isinstance(message, dict):
+            message = json.loads(message)
+        if message.get('table') in self.tables:
+            self.__deliver(message)
+        if self.exchange is not None:
+            self.exchange.on_market_message(message)
+            self.flush()
+        return message
+
+    def flush(self):
+        '''Deliver what the simulated exchange has to send.'''
+        if self.exchange is None:
+            return
+        for message in self.exchange.drain():
+            if message['table'] in self.tables:
+                self.__deliver(message)
+
+    def __send_private_partials(self, tables):
+        if self.exchange is None:
+            return
+        for message in self.exchange.private_partials([t for t in tables if t in PRIVATE_TABLES]):
+            self.__deliver(message)
+
+    def __deliver(self, message):
+        self.stats.record(message)
+        self.on_message(message)
+
+
+class BacktestDriver:
+
+    def __init__(self, recording, symbol="XBTUSD", subscriptions=None, initial_balance=100000000,
+                 maker_fee=-0.00025, taker_fee=0.00075, fill_on_touch=False, **kwargs):
+        '''
+        recording: path of a recording, or an iterable of (time, message) pairs.
+        Other keyword arguments are passed to BitMEXClient.
+        '''
+        from pybitmex.bitmex import BitMEXClient
+
+        self.logger = logging.getLogger(__name__)
+
+        if isinstance(recording, str):
+            recording = read_recording(recording)
+        if subscriptions is None:
+            subscriptions = ["instrument", "orderBookL2", "quote", "trade"] + PRIVATE_TABLES
+
+        self.clock = SimulatedClock()
+        self.exchange = SimulatedRestClient(
+            symbol, self.clock, initial_balance=initial_balance, maker_fee=maker_fee, taker_fee=taker_fee,
+            fill_on_touch=fill_on_touch, order_id_prefix=kwargs.get('order_id_prefix', "")
+        )
+        self.transport = ReplayTransport(recording, self.exchange, self.clock)
+        self.client = BitMEXClient(
+            uri="https://backtest/api/v1/",
+            symbol=symbol,
+            api_key="backtest",
+            api_secret="backtest",
+            subscriptions=subscriptions,
+            ws_transport=self.transport,
+            ws_batched_ingest=False,
+            rest_client=self.exchange,
+            clock=self.clock.now,
+            **kwargs
+        )
+        self.messages = 0
+
+    def run(self, strategy, interval_seconds=None):
+        '''
+        Replay the whole recording, calling strategy(client) after each message,
+        or every interval_seconds of simulated time. Returns the summary of the account.
+        '''
+        started = time.time()
+        next_call = None
+        while self.transport.step() is not None:
+            self.messages += 1
+            if interval_seconds is not None:
+                now = self.clock.time()
+                if next_call is None:
+                    next_call = now
+                if now < next_call:
+                    continue
+                next_call = now + interval_seconds
+            strategy(self.client)
+            self.transport.flush()
+        elapsed = time.time() - started
+        self.logger.info("Replayed %d messages in %.1f seconds." % (self.messages, elapsed))
+        return self.summary()
+
+    def summary(self):
+        result = self.exchange.summary()
+        result['messages'] = self.messages
+        result['simulatedTime'] = self.clock.timestamp()
+        return result
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,222 @@
+import logging
+import threading
+from array import array
+from datetime import datetime, timezone
+
+from pybitmex.models import Bar
+from pybitmex.timestamps import row_seconds
+
+
+# Incremental bar builder fed from the trade feed.
+#
+# Closed bars are kept column by column in flat arrays instead of lists of objects,
+# so a long running aggregator costs a few dozen bytes per bar.
+# Bar objects are only materialized when somebody asks for them.
+# Trades usually come in on the websocket thread while bars are read, or flushed, from others,
+# so every access holds a lock. on_bar_closed is called after the lock is released.
+class BarAggregator:
+
+    TIME = 'time'
+    TICK = 'tick'
+    VOLUME = 'volume'
+
+    # Don't keep more closed bars than this amount. Helps cap memory usage.
+    MAX_BARS = 2000
+
+    def __init__(self, kind, threshold, max_bars=None, on_bar_closed=None):
+        '''
+        kind is one of TIME, TICK and VOLUME.
+        threshold is the bar length in seconds, in trades or in contracts respectively.
+        on_bar_closed, if given, is called with each closed Bar.
+        '''
+        self.logger = logging.getLogger(__name__)
+
+        if kind not in (BarAggregator.TIME, BarAggregator.TICK, BarAggregator.VOLUME):
+            raise ValueError('Unknown bar kind: %s' % kind)
+        if threshold <= 0:
+            raise ValueError('threshold must be positive')
+
+        self.kind = kind
+        self.threshold = threshold
+        self.max_bars = max_bars if max_bars is not None else BarAggregator.MAX_BARS
+        self.on_bar_closed = on_bar_closed
+
+        self.lock = threading.Lock()
+        # Bars closed but not passed to on_bar_closed yet.
+        self.closed_bars = []
+
+        # Closed bars. Timestamps are epoch seconds.
+        self.starts = array('d')
+        self.ends = array('d')
+        self.opens = array('d')
+        self.highs = array('d')
+        self.lows = array('d')
+        self.closes = array('d')
+        self.volumes = array('q')
+        self.buy_volumes = array('q')
+        self.sell_volumes = array('q')
+        self.turnovers = array('d')
+        self.counts = array('q')
+
+        # The bar being built.
+        self.current = None
+
+    def __len__(self):
+        with self.lock:
+            return len(self.closes)
+
+    def on_message(self, table, action, rows):
+        '''Listener for the websocket trade table.'''
+        if table == 'trade' and action == 'insert':
+            self.add_trade_rows(rows)
+
+    def add_trade_rows(self, rows):
+        with self.lock:
+            for t in rows:
+                self.__add_trade(row_seconds(t), t['side'], float(t['price']), int(t['size']))
+        self.__notify()
+
+    def add_trade(self, timestamp, side, price, size):
+        '''Add a trade. timestamp is in epoch seconds.'''
+        with self.lock:
+            self.__add_trade(timestamp, side, price, size)
+        self.__notify()
+
+    def __add_trade(self, timestamp, side, price, size):
+        current = self.current
+        if current is not None and self.kind == BarAggregator.TIME and current[1] <= timestamp:
+            self.__close()
+            current = None
+
+        if current is None:
+            if self.kind == BarAggregator.TIME:
+                start = (timestamp // self.threshold) * self.threshold
+                end = start + self.threshold
+                self.__fill_gaps(start)
+            else:
+                start = timestamp
+                end = timestamp
+            # start, end, open, high, low, close, volume, buy volume, sell volume, turnover, count
+            current = [start, end, price, price, price, price, 0, 0, 0, 0.0, 0]
+            self.current = current
+
+        if price > current[3]:
+            current[3] = price
+        if price < current[4]:
+            current[4] = price
+        current[5] = price
+        current[6] += size
+        if side == 'Buy':
+            current[7] += size
+        else:
+            current[8] += size
+        current[9] += price * size
+        current[10] += 1
+        if self.kind != BarAggregator.TIME:
+            current[1] = timestamp
+
+        # Tick and volume bars close as soon as they are full.
+        # A volume bar is not split, so it may overshoot the threshold by the size of its last trade.
+        if self.kind == BarAggregator.TICK and self.threshold <= current[10]:
+            self.__close()
+        elif self.kind == BarAggregator.VOLUME and self.threshold <= current[6]:
+            self.__close()
+
+    def flush(self):
+        '''Close the bar being built, if any.'''
+        with self.lock:
+            if self.current is not None:
+                self.__close()
+        self.__notify()
+
+    def flush_until(self, now):
+        '''
+        Time bars only close when the next trade arrives. Call this on a timer to close the bar being built
+        once its interval has ended by now (epoch seconds), and to emit empty bars for the intervals without trades.
+        '''
+        if self.kind != BarAggregator.TIME:
+            return
+        with self.lock:
+            if self.current is not None and self.current[1] <= now:
+                self.__close()
+            if self.current is None:
+                self.__fill_gaps(now)
+        self.__notify()
+
+    def current_bar(self):
+        '''Return the bar being built, or None.'''
+        with self.lock:
+            if self.current is None:
+                return None
+            return self.__to_bar(*self.current)
+
+    def bars(self, count=None):
+        '''Return the closed bars, oldest first. Only the last count bars if count is given.'''
+        with self.lock:
+            size = len(self.closes)
+            begin = 0 if count is None else max(0, size - count)
+            return [self.__bar_at(i) for i in range(begin, size)]
+
+    def __bar_at(self, i):
+        return self.__to_bar(
+            self.starts[i], self.ends[i], self.opens[i], self.highs[i], self.lows[i], self.closes[i],
+            self.volumes[i], self.buy_volumes[i], self.sell_volumes[i], self.turnovers[i], self.counts[i]
+        )
+
+    @staticmethod
+    def __to_bar(start, end, open_price, high, low, close, volume, buy_volume, sell_volume, turnover, count):
+        return Bar(
+            datetime.fromtimestamp(start, timezone.utc), datetime.fromtimestamp(end, timezone.utc),
+            open_price, high, low, close, volume, buy_volume, sell_volume, turnover, count
+        )
+
+    def __fill_gaps(self, until):
+        '''Emit empty bars at the last close for the whole intervals between the last bar and until.'''
+        if not self.closes:
+            return
+        close = self.closes[-1]
+        end = self.ends[-1]
+        # After a long pause, only the latest max_bars intervals matter.
+        end = max(end, end + ((until - end) // self.threshold - self.max_bars) * self.threshold)
+        while end + self.threshold <= until:
+            self.current = [end, end + self.threshold, close, close, close, close, 0, 0, 0, 0.0, 0]
+            self.__close()
+            end += self.threshold
+
+    def __close(self):
+        start, end, open_price, high, low, close, volume, buy_volume, sell_volume, turnover, count = self.current
+        self.current = None
+
+        self.starts.append(start)
+        self.ends.append(end)
+        self.opens.append(open_price)
+        self.highs.append(high)
+        self.lows.append(low)
+        self.closes.append(close)
+        self.volumes.append(volume)
+        self.buy_volumes.append(buy_volume)
+        self.sell_volumes.append(sell_volume)
+        self.turnovers.append(turnover)
+        self.counts.append(count)
+
+        # Limit the number of bars to avoid excessive memory usage.
+        if self.on_bar_closed is not None:
+            self.closed_bars.append(self.__bar_at(len(self.closes) - 1))
+
+        if self.max_bars < len(self.closes):
+            drop = max(1, self.max_bars // 2)
+            for column in (self.starts, self.ends, self.opens, self.highs, self.lows, self.closes,
+                           self.volumes, self.buy_volumes, self.sell_volumes, self.turnovers, self.counts):
+                del column[:drop]
+
+    def __notify(self):
+        '''Pass the bars closed so far to on_bar_closed. Called without holding the lock.'''
+        if self.on_bar_closed is None:
+            return
+        with self.lock:
+            closed_bars, self.closed_bars = self.closed_bars, []
+        for bar in closed_bars:
+            try:
+                self.on_bar_closed(bar)
+            except Exception:
+                self.logger.exception('Bar listener failed.')
@@ -1,12 +1,14 @@
 import logging
-from datetime import datetime, timezone
-from dateutil.parser import parse
+from datetime import datetime
 
-from pybitmex import ws, rest, models
+from pybitmex import ws, rest, models, bars, cache, transport, tracker, orderstate, coalesce, deltas, history, timestamps
 
 
 class BitMEXClient:
 
+    # Tables the position tracker listens to.
+    POSITION_TRACKER_TABLES = ['execution', 'position', 'margin', 'instrument']
+
     def __init__(
             self,
             uri="https://testnet.bitmex.com/api/v1/",
@@ -19,14 +21,72 @@ class BitMEXClient:
             order_id_prefix="",
             agent_name="trading_bot",
             http_timeout=7,
+            http_pool_maxsize=10,
+            http_warm_up_connections=0,
+            http_keep_alive_interval_seconds=None,
             expiration_seconds=3600,
-            ws_refresh_interval_seconds=600
+            ws_refresh_interval_seconds=600,
+            ws_dense_order_book=False,
+            ws_projections=None,
+            ws_compact_rows=False,
+            ws_compression=False,
+            ws_parse_timestamps=False,
+            market_data_publish_name=None,
+            market_data_source_name=None,
+            optimistic_order_state=False,
+            coalesce_window_seconds=None,
+            coalesce_max_batch_size=None,
+            public_ws_client=None,
+            ws_transport=None,
+            ws_batched_ingest=True,
+            rest_client=None,
+            clock=None
     ):
+        """
+        http_warm_up_connections, http_keep_alive_interval_seconds: see rest.RestClient.
+        ws_compression: negotiate permessage-deflate on the websocket. Needs the websockets package, see the deflate extra.
+        market_data_publish_name: publish the public tables of our websocket to a shared memory segment of this name.
+        market_data_source_name: read the public tables from the shared memory segment of this name
+        instead of subscribing to them. The websocket, if any, then only subscribes to the private tables.
+        The order book is shared as a whole, so ws_order_book_changes_since is not available from it.
+        optimistic_order_state: show orders as open from the moment they are submitted, and as gone from the moment
+        they are canceled, without waiting for the order table to confirm.
+        coalesce_window_seconds: merge the placements and cancels submitted from several threads within this window
+        into bulk requests of up to coalesce_max_batch_size orders. See coalesce.OrderRequestCoalescer.
+        public_ws_client: read the public tables from this websocket client, shared with other clients,
+        instead of subscribing to them. It is not closed with this client. See accounts.MultiAccountClient.
+        ws_parse_timestamps, ws_transport, ws_batched_ingest, clock: see ws.BitMEXWebSocketClient. ws_transport overrides ws_compression.
+        clock is also the time of the position tracker and of optimistic_order_state.
+        rest_client: send requests through this client instead of building a rest.RestClient,
+        e.g. a backtest.SimulatedRestClient.
+        """
         self.logger = logging.getLogger(__name__)
+        # The clock in epoch seconds, for the position tracker and the order state.
+        self.clock_seconds = (lambda: clock().timestamp()) if clock is not None else None
 
         self.uri = uri
         self.symbol = symbol
         self.is_running = True
+
+        if public_ws_client is not None:
+            self.public_ws_client = public_ws_client
+            self.owns_public_ws_client = False
+        elif market_data_source_name is not None:
+            # Shared memory needs Python 3.8+.
+            from pybitmex import shm
+            self.public_ws_client = shm.SharedMarketDataReader(market_data_source_name)
+            self.owns_public_ws_client = True
+        else:
+            self.public_ws_client = None
+            self.owns_public_ws_client = False
+
+        if self.public_ws_client is not None:
+            if subscriptions is None:
+                subscriptions = ws.PRIVATE_TABLES
+            subscriptions = [s for s in subscriptions if s in ws.PRIVATE_TABLES]
+            # Nothing to read from a socket if we're not authenticated.
+            use_websocket = use_websocket and api_key is not None and 0 < len(subscriptions)
+
         if use_websocket:
             self.ws_client = ws.BitMEXWebSocketClient(
                 endpoint=uri,
@@ -34,13 +94,29 @@ class BitMEXClient:
                 api_key=api_key,
                 api_secret=api_secret,
                 subscriptions=subscriptions,
-                expiration_seconds=expiration_seconds
+                expiration_seconds=expiration_seconds,
+                dense_order_book=ws_dense_order_book,
+                projections=ws_projections,
+                compact_rows=ws_compact_rows,
+                batched_ingest=ws_batched_ingest,
+                parse_timestamps=ws_parse_timestamps,
+                transport=ws_transport if ws_transport is not None else
+                transport.DeflateTransport() if ws_compression else transport.WebSocketAppTransport(),
+                clock=clock
             )
             self.ws_refresh_interval_seconds = ws_refresh_interval_seconds
         else:
             self.ws_client = None
 
-        if use_rest:
+        if market_data_publish_name is not None:
+            from pybitmex import shm
+            self.market_data_publisher = shm.SharedMarketDataPublisher(market_data_publish_name, self.ws_client)
+        else:
+            self.market_data_publisher = None
+
+        if rest_client is not None:
+            self.rest_client = rest_client
+        elif use_rest:
             self.rest_client = rest.RestClient(
                 uri=uri,
                 api_key=api_key,
@@ -49,25 +125,104 @@ class BitMEXClient:
                 order_id_prefix=order_id_prefix,
                 agent_name=agent_name,
                 timeout=http_timeout,
-                expiration_seconds=expiration_seconds
+                expiration_seconds=expiration_seconds,
+                pool_maxsize=http_pool_maxsize,
+                warm_up_connections=http_warm_up_connections,
+                keep_alive_interval_seconds=http_keep_alive_interval_seconds
             )
         else:
             self.rest_client = None
         self.order_id_prefix = order_id_prefix
 
+        if self.rest_client is not None and coalesce_window_seconds is not None:
+            self.order_requests = coalesce.OrderRequestCoalescer(
+                self.rest_client, window_seconds=coalesce_window_seconds, max_batch_size=coalesce_max_batch_size
+            )
+        else:
+            # Same interface, one request per call.
+            self.order_requests = self.rest_client
+
+        # Derived views, recomputed only when their source tables change.
+        self.view_cache = cache.ViewCache()
+        self.position_tracker = None
+        self.book_delta_log = None
+        self.bar_aggregators = []
+
+        if optimistic_order_state:
+            self.order_state = orderstate.OrderStateBook(clock=self.clock_seconds)
+            if self.ws_client is not None:
+                self.ws_client.add_listener('order', self.order_state.on_message)
+        else:
+            self.order_state = None
+
     def close(self):
         self.is_running = False
 
+        # The public websocket client may be shared and outlive us. Stop feeding our views from it.
+        for aggregator in list(self.bar_aggregators):
+            self.ws_remove_bar_aggregator(aggregator)
+        if self.book_delta_log is not None:
+            deltas.unfollow_order_book(self._select_ws_client('orderBookL2'), self.book_delta_log)
+        if self.position_tracker is not None:
+            for table_name in BitMEXClient.POSITION_TRACKER_TABLES:
+                self._select_ws_client(table_name).remove_listener(table_name, self.position_tracker.on_message)
+
+        if self.market_data_publisher:
+            self.market_data_publisher.exit()
+
+        if self.public_ws_client and self.owns_public_ws_client:
+            self.public_ws_client.exit()
+
         if self.ws_client:
             self.ws_client.exit()
 
+        if self.order_requests is not self.rest_client:
+            self.order_requests.exit()
+
         if self.rest_client:
             self.rest_client.close()
 
     def get_last_ws_update(self, table_name):
-        return self.ws_client.updates.get(table_name)
+        return self._select_ws_client(table_name).updates.get(table_name)
+
+    def ws_subscribe(self, tables):
+        self._check_own_subscriptions(tables)
+        self.ws_client.subscribe(tables)
+
+    def ws_unsubscribe(self, tables):
+        self._check_own_subscriptions(tables)
+        self.ws_client.unsubscribe(tables)
+
+    def ws_switch_order_book(self, table_name):
+        """Switch between orderBookL2, orderBookL2_25 and orderBook10 without reconnecting."""
+        self._check_own_subscriptions([table_name])
+        self.ws_client.switch_order_book(table_name)
+
+    def _check_own_subscriptions(self, tables):
+        # The public tables come from a feed other clients read too. Changing it is up to its owner.
+        shared = [t for t in tables if self._select_ws_client(t) is not self.ws_client]
+        if shared:
+            raise ValueError("Tables %s are read from a shared market data feed and can't be changed from this client."
+                             % ", ".join(shared))
+
+    def ws_transport_stats(self):
+        return self.ws_client.transport_stats()
+
+    def ws_ingest_stats(self):
+        return self.ws_client.ingest_stats()
+
+    def view_cache_stats(self):
+        return self.view_cache.stats()
+
+    def _cached_view(self, name, table_names, compute, extra_key=None):
+        version_key = tuple(
+            (table_name, self._select_ws_client(table_name).versions.get(table_name)) for table_name in table_names
+        ) + (extra_key,)
+        return self.view_cache.get(name, version_key, compute)
 
     def _select_ws_client(self, table_name):
+        if self.public_ws_client is not None and table_name in ws.PUBLIC_TABLES:
+            return self.public_ws_client
         return self.ws_client
 
     def ws_raw_instrument(self):
@@ -82,11 +237,26 @@ class BitMEXClient:
         return state == "Open" or state == "Closed"
 
     def ws_raw_order_books_of_market(self):
-        table_name = self.ws_client.get_order_book_table_name()
+        table_name = self._select_ws_client('orderBookL2').get_order_book_table_name()
         return self._select_ws_client(table_name).market_depth()
 
     def ws_sorted_bids_and_asks_of_market(self):
+        table_name = self._select_ws_client('orderBookL2').get_order_book_table_name()
+        return self._cached_view('bids_and_asks', [table_name], lambda: self._sorted_bids_and_asks(table_name))
+
+    def _sorted_bids_and_asks(self, table_name):
+        dense_book = self._select_ws_client(table_name).dense_order_book()
+        if dense_book is not None:
+            return dense_book.bids(), dense_book.asks()
+
         depth = self.ws_raw_order_books_of_market()
+        if table_name == 'orderBook10':
+            # A single row holding the top levels as [price, size] pairs.
+            if not depth:
+                return [], []
+            return ([{"price": float(p), "size": int(s)} for p, s in depth[0]["bids"]],
+                    [{"price": float(p), "size": int(s)} for p, s in depth[0]["asks"]])
+
         bids = sorted([b for b in depth if b["side"] == "Buy"], key=lambda b: b["price"], reverse=True)
         asks = sorted([b for b in depth if b["side"] == "Sell"], key=lambda b: b["price"], reverse=False)
 
@@ -99,11 +269,43 @@ class BitMEXClient:
         return self._select_ws_client('trade').recent_trades()
 
     def ws_sorted_recent_trade_objects_of_market(self, reverse=False):
+        return self._cached_view('recent_trades_' + str(reverse), ['trade'],
+                                 lambda: self._sorted_recent_trade_objects(reverse))
+
+    def _sorted_recent_trade_objects(self, reverse):
         raw_trades = self.ws_raw_recent_trades_of_market()
-        result = [models.Trade(t["trdMatchID"], parse(t["timestamp"]).astimezone(timezone.utc),
+        result = [models.Trade(t["trdMatchID"], timestamps.row_datetime(t),
                   t["side"], float(t["price"]), int(t["size"])) for t in raw_trades]
         return sorted([t for t in result], key=lambda t: (t.timestamp, t.trd_match_id), reverse=reverse)
 
+    def ws_order_book_changes_since(self, cursor=None):
+        """
+        Return (cursor, changes, is_snapshot): the order book levels changed since cursor, as
+        {"side", "price", "size"} dicts with size 0 for removed levels, and the cursor to pass next time.
+        Without a cursor, or when it is too old, changes is a snapshot of the whole book and is_snapshot is True.
+        See deltas.BookDeltaLog. Changes are logged from the first call on.
+        """
+        if self.book_delta_log is None:
+            book_delta_log = deltas.BookDeltaLog()
+            deltas.follow_order_book(self._select_ws_client('orderBookL2'), book_delta_log)
+            self.book_delta_log = book_delta_log
+        return self.book_delta_log.changes_since(cursor)
+
+    def ws_add_bar_aggregator(self, kind, threshold, max_bars=None, on_bar_closed=None):
+        """
+        Build time, tick or volume bars incrementally from the trades inserted from now on.
+        See bars.BarAggregator for the arguments.
+        """
+        aggregator = bars.BarAggregator(kind, threshold, max_bars=max_bars, on_bar_closed=on_bar_closed)
+        self._select_ws_client('trade').add_listener('trade', aggregator.on_message)
+        self.bar_aggregators.append(aggregator)
+        return aggregator
+
+    def ws_remove_bar_aggregator(self, aggregator):
+        self._select_ws_client('trade').remove_listener('trade', aggregator.on_message)
+        if aggregator in self.bar_aggregators:
+            self.bar_aggregators.remove(aggregator)
+
     def ws_raw_current_position(self):
         """
         [{'account': XXXXX, 'symbol': 'XBTUSD', 'currency': 'XBt', 'underlying': 'XBT',
@@ -136,6 +338,9 @@ class BitMEXClient:
         return self._select_ws_client('position').positions()
 
     def ws_current_position_size(self):
+        return self._cached_view('position_size', ['position'], self._current_position_size)
+
+    def _current_position_size(self):
         json_array = self.ws_raw_current_position()
         for each in json_array:
             if each["symbol"] == self.symbol:
@@ -162,20 +367,29 @@ class BitMEXClient:
         'multiLegReportingType': 'SingleSecurity', 'text': 'Submission from www.bitmex.com',
         'transactTime': '2019-03-25T07:10:34.290Z', 'timestamp': '2019-03-25T07:10:34.290Z'}]
         """
+        if self.order_state is not None:
+            self.order_state.expire()
+            return self._cached_view('open_orders', ['order'], self._open_order_objects, self.order_state.version)
+        return self._cached_view('open_orders', ['order'], self._open_order_objects)
+
+    def _open_order_objects(self):
         # clOrdID, orderID, side, orderQty, price
         def order_obj_from_json(json):
             return models.OpenOrder(
                 json["orderID"], json["clOrdID"],
                 json["side"], json["orderQty"], json["price"],
-                parse(json["timestamp"]).astimezone(timezone.utc)
+                timestamps.row_datetime(json)
             )
 
         json_array = self.ws_raw_open_orders_of_account()
+        if self.order_state is not None:
+            json_array = self.order_state.merge(json_array)
         bids = [order_obj_from_json(each) for each in json_array if each["side"] == "Buy"]
         asks = [order_obj_from_json(each) for each in json_array if each["side"] == "Sell"]
+        # Orders without a price, such as stops, go last.
         return models.OpenOrders(
-            bids=sorted(bids, key=lambda o: o.price, reverse=True),
-            asks=sorted(asks, key=lambda o: o.price, reverse=False)
+            bids=sorted(bids, key=lambda o: (o.price is not None, o.price or 0), reverse=True),
+            asks=sorted(asks, key=lambda o: (o.price is None, o.price or 0))
         )
 
     def ws_recent_trades_of_account(self):
@@ -217,16 +431,66 @@ class BitMEXClient:
         'excessMarginPcnt': 1, 'availableMargin': 377076688, 'withdrawableMargin': 377076688,
         'timestamp': '2019-03-25T07:56:25.462Z', 'grossLastValue': 756090, 'commission': None}
         """
+        return self._cached_view('balances', ['margin'], self._balances_of_account)
+
+    def _balances_of_account(self):
         satoshis_for_btc = 100000000
         data = self.ws_raw_balances_of_account()
         withdrawable_balance = float(data['withdrawableMargin']) / satoshis_for_btc
         wallet_balance = float(data['walletBalance']) / satoshis_for_btc
         return withdrawable_balance, wallet_balance
 
+    def ws_position_tracker(self, reconcile_interval_seconds=60):
+        """
+        Return the local position, PnL and margin tracker of the symbol, fed by the execution stream
+        and reconciled against the position and margin tables every reconcile_interval_seconds.
+        Created on the first call.
+        """
+        if self.position_tracker is None:
+            instrument = self.ws_raw_instrument()
+            position_tracker = tracker.PositionTracker(
+                self.symbol,
+                is_inverse=instrument.get('isInverse', True),
+                multiplier=instrument.get('multiplier', -100000000),
+                reconcile_interval_seconds=reconcile_interval_seconds,
+                clock=self.clock_seconds
+            )
+            if instrument.get('markPrice') is not None:
+                position_tracker.mark_price = float(instrument['markPrice'])
+            position_tracker.reconcile_source = self._position_and_margin_rows
+            position_tracker.reconcile(*self._position_and_margin_rows())
+            for table_name in BitMEXClient.POSITION_TRACKER_TABLES:
+                self._select_ws_client(table_name).add_listener(table_name, position_tracker.on_message)
+            self.position_tracker = position_tracker
+        return self.position_tracker
+
+    def _position_and_margin_rows(self):
+        ws_client = self._select_ws_client('position')
+        position = None
+        for each in ws_client.data.get('position', []):
+            if each["symbol"] == self.symbol:
+                position = each
+        margins = self._select_ws_client('margin').data.get('margin')
+        return position, margins[0] if margins else None
+
     def rest_place_orders(self, new_order_list, post_only=True, max_retries=None):
         if len(new_order_list) == 0:
             return
-        self.rest_client.place_orders([o for o in new_order_list], post_only=post_only, max_retries=max_retries)
+        orders = [o for o in new_order_list]
+        if self.order_state is None:
+            return self.order_requests.place_orders(orders, post_only=post_only, max_retries=max_retries)
+
+        for order in orders:
+            if order.get('clOrdID') is None:
+                order['clOrdID'] = self.rest_client.new_client_order_id()
+        self.order_state.add_pending_orders(orders)
+        try:
+            result = self.order_requests.place_orders(orders, post_only=post_only, max_retries=max_retries)
+        except Exception:
+            self.order_state.discard_pending_orders([o['clOrdID'] for o in orders])
+            raise
+        self.order_state.on_orders_placed(result)
+        return result
 
     def rest_market_close_position(self, order, max_retries=None):
         self.rest_client.market_close_position(order, max_retries=max_retries)
@@ -234,11 +498,40 @@ class BitMEXClient:
     def rest_cancel_orders(self, order_id_list, max_retries=None):
         if len(order_id_list) == 0:
             return
-        self.rest_client.cancel_orders(order_id_list, max_retries=max_retries)
+        if self.order_state is None:
+            return self.order_requests.cancel_orders(order_id_list, max_retries=max_retries)
+
+        self.order_state.add_pending_cancels(order_id_list)
+        try:
+            return self.order_requests.cancel_orders(order_id_list, max_retries=max_retries)
+        except Exception:
+            self.order_state.discard_pending_cancels(order_id_list)
+            raise
+
+    def rest_cancel_orders_by_client_order_id(self, client_order_id_list, max_retries=None):
+        if len(client_order_id_list) == 0:
+            return
+        if self.order_state is None:
+            return self.order_requests.cancel_orders_by_client_order_id(client_order_id_list, max_retries=max_retries)
+
+        self.order_state.add_pending_cancels(client_order_id_list)
+        try:
+            return self.order_requests.cancel_orders_by_client_order_id(client_order_id_list, max_retries=max_retries)
+        except Exception:
+            self.order_state.discard_pending_cancels(client_order_id_list)
+            raise
 
     def rest_cancel_all_orders(self):
-        open_orders = self.ws_open_order_objects_of_account()
-        self.rest_cancel_orders([o.order_id for o in open_orders.to_list()])
+        open_orders = self.ws_open_order_objects_of_account().to_list()
+        self.rest_cancel_orders([o.order_id for o in open_orders if o.order_id is not None])
+        # Submitted orders we have no orderID for yet, with optimistic_order_state.
+        self.rest_cancel_orders_by_client_order_id([o.client_order_id for o in open_orders if o.order_id is None])
+
+    def rest_connection_stats(self):
+        return self.rest_client.get_connection_stats()
+
+    def rest_coalescer_stats(self):
+        return self.order_requests.stats() if self.order_requests is not self.rest_client else None
 
     def rest_get_raw_orders_of_account(self, filter_json_obj, count=500):
         return self.rest_client.get_orders_of_account(filter_json_obj, count)
@@ -253,6 +546,22 @@ class BitMEXClient:
     def rest_get_raw_margin_of_account(self):
         return self.rest_client.get_user_margin()
 
+    def rest_load_public_trades(self, start_time, end_time, max_workers=4, requests_per_minute=None):
+        """
+        Public trades of the symbol from start_time until end_time, as history.Columns of
+        timestamp, side (1 for Buy, -1 for Sell), price and size arrays.
+        """
+        loader = history.HistoryLoader(self.rest_client, max_workers=max_workers, requests_per_minute=requests_per_minute)
+        return loader.load_trades(start_time, end_time)
+
+    def rest_load_trade_buckets(self, bin_size, start_time, end_time, max_workers=4, requests_per_minute=None):
+        """
+        Trade buckets of the symbol from start_time until end_time, as history.Columns of
+        timestamp, open, high, low, close, trades, volume, vwap and turnover arrays.
+        """
+        loader = history.HistoryLoader(self.rest_client, max_workers=max_workers, requests_per_minute=requests_per_minute)
+        return loader.load_buckets(bin_size, start_time, end_time)
+
     @staticmethod
     def create_daily_filter(year, month, day):
         return {"timestamp.date": "{:04}-{:02}-{:02}".format(year, month, day)}
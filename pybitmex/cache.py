@@ -0,0 +1,31 @@
+# Memoization of views derived from websocket tables.
+#
+# Every table has a version number, bumped each time a message of it is applied.
+# A view is recomputed only when the versions of the tables it is derived from have changed.
+# Cached values are shared between callers, so treat them as read-only.
+class ViewCache:
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, version_key, compute):
+        '''
+        Return the value cached under name if it was computed at version_key, else compute() it.
+        Read the versions before computing: if a table changes meanwhile, the next call recomputes.
+        '''
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] == version_key:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        value = compute()
+        self.entries[name] = (version_key, value)
+        return value
+
+    def clear(self):
+        self.entries = {}
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
@@ -0,0 +1,174 @@
+import logging
+import queue
+import threading
+import time
+
+from pybitmex.rest import RestClientError
+
+
+# Merges order placements and cancels submitted by several threads into bulk REST calls.
+#
+# Callers block in place_orders() or cancel_orders() as they would on RestClient. A single sender
+# thread collects the requests submitted within window_seconds of the first one, or until
+# max_batch_size orders are collected, and sends each kind as one order/bulk POST or one DELETE order.
+# Every caller gets back the rows of its own orders, or the error of the batch it was part of.
+# When BitMEX rejects a batch with a 400 error, each caller's request is sent again on its own,
+# so that an invalid order only fails the caller who submitted it.
+class OrderRequestCoalescer:
+
+    # Don't put more orders than this amount in one bulk request.
+    MAX_BATCH_SIZE = 50
+
+    def __init__(self, rest_client, window_seconds=0.05, max_batch_size=None):
+        self.logger = logging.getLogger(__name__)
+
+        self.rest_client = rest_client
+        self.window_seconds = window_seconds
+        self.max_batch_size = max_batch_size if max_batch_size is not None else OrderRequestCoalescer.MAX_BATCH_SIZE
+        self.queue = queue.Queue()
+
+        self.requests = 0
+        self.batches = 0
+
+        self.running = True
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def exit(self):
+        self.running = False
+        self.queue.put(None)
+        self.thread.join()
+
+    def place_orders(self, orders, post_only=True, max_retries=None):
+        '''Same as RestClient.place_orders, sent together with the placements of other threads.'''
+        for order in orders:
+            if order.get('clOrdID') is None:
+                order['clOrdID'] = self.rest_client.new_client_order_id()
+        return self.__submit(_Request(('place', post_only, max_retries), orders))
+
+    def cancel_orders(self, order_id_list, max_retries=None):
+        '''Same as RestClient.cancel_orders, sent together with the cancels of other threads.'''
+        return self.__submit(_Request(('cancel', max_retries), order_id_list))
+
+    def cancel_orders_by_client_order_id(self, client_order_id_list, max_retries=None):
+        '''Same as RestClient.cancel_orders_by_client_order_id, sent together with the cancels of other threads.'''
+        return self.__submit(_Request(('cancel_by_client_order_id', max_retries), client_order_id_list))
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'batches': self.batches
+        }
+
+    def __submit(self, request):
+        if not self.running:
+            raise RestClientError("Order requests are no longer accepted.", -1)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def __run(self):
+        while self.running:
+            request = self.queue.get()
+            if request is None:
+                break
+            pending = [request]
+            size = len(request.items)
+            deadline = time.time() + self.window_seconds
+            while size < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.running = False
+                    break
+                pending.append(request)
+                size += len(request.items)
+            self.__send(pending)
+
+        # Fail whatever came in after exit().
+        while True:
+            try:
+                request = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None:
+                request.error = RestClientError("Order requests are no longer accepted.", -1)
+                request.done.set()
+
+    def __send(self, pending):
+        groups = {}
+        for request in pending:
+            groups.setdefault(request.kind, []).append(request)
+
+        for kind, requests in groups.items():
+            # Split into bulk requests of up to max_batch_size orders, without splitting a caller's list.
+            batch = []
+            size = 0
+            for request in requests:
+                if batch and self.max_batch_size < size + len(request.items):
+                    self.__send_batch(kind, batch)
+                    batch = []
+                    size = 0
+                batch.append(request)
+                size += len(request.items)
+            if batch:
+                self.__send_batch(kind, batch)
+
+    def __send_batch(self, kind, batch):
+        items = [item for request in batch for item in request.items]
+        self.requests += len(batch)
+        self.batches += 1
+        try:
+            rows = self.__call(kind, items)
+            if kind[0] == 'place':
+                by_id = dict((row.get('clOrdID'), row) for row in rows or [])
+                for request in batch:
+                    request.result = [by_id[o['clOrdID']] for o in request.items if o['clOrdID'] in by_id]
+            else:
+                by_id = dict((row.get('orderID' if kind[0] == 'cancel' else 'clOrdID'), row) for row in rows or [])
+                for request in batch:
+                    # None for orders already gone, as RestClient returns for them.
+                    result = [by_id[o] for o in request.items if o in by_id]
+                    request.result = result if rows is not None else None
+        except RestClientError as e:
+            if 1 < len(batch) and e.error_code == 400:
+                # A validation error, most likely of one caller's order. Send each caller's request on its own,
+                # so that only that caller gets the error. Other errors, such as rate limits or
+                # authentication failures, would only repeat, and go to every caller as they are.
+                self.logger.info("Batch of %d requests rejected, resending them one by one: %s" % (len(batch), e))
+                self.requests -= len(batch)
+                for request in batch:
+                    self.__send_batch(kind, [request])
+                return
+            for request in batch:
+                request.error = e
+        except Exception as e:
+            for request in batch:
+                request.error = e
+        for request in batch:
+            request.done.set()
+
+    def __call(self, kind, items):
+        if kind[0] == 'place':
+            return self.rest_client.place_orders(items, post_only=kind[1], max_retries=kind[2])
+        if kind[0] == 'cancel':
+            return self.rest_client.cancel_orders(items, max_retries=kind[1])
+        return self.rest_client.cancel_orders_by_client_order_id(items, max_retries=kind[1])
+
+
+class _Request:
+
+    def __init__(self, kind, items):
+        self.kind = kind
+        self.items = items
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
@@ -0,0 +1,137 @@
+import logging
+import threading
+from collections import deque
+
+from pybitmex.ws import ORDER_BOOK_TABLES
+
+
+# Changed order book levels, for consumers that mirror the book.
+#
+# The log listens to the order book tables and numbers each level change with a sequence number.
+# A consumer keeps the sequence number it has read up to, its cursor, and asks for the changes since.
+# A change is (side, price, size), size 0 meaning the level was removed.
+# When the cursor is older than the changes kept, or the book was replaced by a partial since,
+# the consumer gets a snapshot of the whole book instead, and must replace its mirror with it.
+class BookDeltaLog:
+
+    # Don't keep more changes than this amount. Helps cap memory usage.
+    MAX_CHANGES = 100000
+
+    def __init__(self, max_changes=None):
+        self.logger = logging.getLogger(__name__)
+
+        self.max_changes = max_changes if max_changes is not None else BookDeltaLog.MAX_CHANGES
+        self.lock = threading.Lock()
+        # The order book table followed.
+        self.table = None
+        # Level key -> [side, price, size]. Keys are ids, or (side, price) for orderBook10.
+        self.levels = {}
+        # (sequence, side, price, size)
+        self.changes = deque()
+        self.sequence = 0
+        # Every change after this sequence number is in self.changes.
+        self.base_sequence = 0
+
+    def on_message(self, table, action, rows):
+        '''Listener for the order book tables.'''
+        with self.lock:
+            if action == 'partial':
+                # The book we follow is replaced, possibly by a different table after a switch.
+                self.table = table
+                self.levels = {}
+                self.changes.clear()
+                self.sequence += 1
+                self.base_sequence = self.sequence
+                self.__apply_rows(table, action, rows, record=False)
+                return
+            if table != self.table:
+                return
+            self.__apply_rows(table, action, rows, record=True)
+            self.__trim()
+
+    def changes_since(self, cursor=None):
+        '''
+        Returns (new cursor, changes, is_snapshot).
+        changes are {"side", "price", "size"} dicts, one per level, the latest change of each.
+        is_snapshot is True when changes are the whole book instead of the changes since cursor.
+        '''
+        with self.lock:
+            if cursor is None or cursor < self.base_sequence or self.sequence < cursor:
+                return self.sequence, self.__snapshot(), True
+
+            latest = {}
+            # Newest first, stopping at the cursor.
+            for sequence, side, price, size in reversed(self.changes):
+                if sequence <= cursor:
+                    break
+                if (side, price) not in latest:
+                    latest[(side, price)] = size
+            changes = [{"side": side, "price": price, "size": size} for (side, price), size in latest.items()]
+            return self.sequence, changes, False
+
+    def __snapshot(self):
+        return [{"side": side, "price": price, "size": size} for side, price, size in self.levels.values()]
+
+    def __apply_rows(self, table, action, rows, record):
+        if table == 'orderBook10':
+            # Each message is the top of the book. Diff it against the previous one.
+            levels = {}
+            for row in rows:
+                for side, pairs in (('Buy', row.get('bids', [])), ('Sell', row.get('asks', []))):
+                    for price, size in pairs:
+                        levels[(side, float(price))] = [side, float(price), int(size)]
+            if record:
+                for key, (side, price, size) in self.levels.items():
+                    if key not in levels:
+                        self.__record(side, price, 0)
+                for key, level in levels.items():
+                    previous = self.levels.get(key)
+                    if previous is None or previous[2] != level[2]:
+                        self.__record(*level)
+            self.levels = levels
+            return
+
+        for row in rows:
+            level_id = row['id']
+            if action == 'delete':
+                level = self.levels.pop(level_id, None)
+                if level is not None and record:
+                    self.__record(level[0], level[1], 0)
+                continue
+            level = self.levels.get(level_id)
+            if level is None:
+                if row.get('price') is None:
+                    # An update of a level we never saw.
+                    continue
+                level = [row['side'], float(row['price']), 0]
+                self.levels[level_id] = level
+            elif row.get('price') is not None:
+                level[1] = float(row['price'])
+            if row.get('size') is not None:
+                level[2] = int(row['size'])
+            if record:
+                self.__record(*level)
+
+    def __record(self, side, price, size):
+        self.sequence += 1
+        self.changes.append((self.sequence, side, price, size))
+
+    def __trim(self):
+        if self.max_changes < len(self.changes):
+            # Keep the later half, so that we don't trim on every change.
+            for _ in range(len(self.changes) - self.max_changes // 2):
+                self.base_sequence = self.changes.popleft()[0]
+
+
+def follow_order_book(ws_client, delta_log):
+    '''Feed delta_log from the order book of ws_client, starting with a snapshot of the current book.'''
+    for table in ORDER_BOOK_TABLES:
+        ws_client.add_listener(table, delta_log.on_message)
+    table = ws_client.get_order_book_table_name()
+    if table in ws_client.data:
+        delta_log.on_message(table, 'partial', ws_client.market_depth())
+
+
+def unfollow_order_book(ws_client, delta_log):
+    for table in ORDER_BOOK_TABLES:
+        ws_client.remove_listener(table, delta_log.on_message)
@@ -0,0 +1,188 @@
+import logging
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta, timezone
+
+from pybitmex.timestamps import timestamp_seconds
+
+
+# Bulk loading of public trade history over a time range.
+#
+# The range is cut into chunks, which are fetched in parallel. Within a chunk, pages are requested
+# one after another with a growing start offset until a short page comes back.
+# All requests share one rate limiter. Results are stored column by column in arrays
+# of machine types, which take a fraction of the memory of the rows as dicts.
+
+# Sides of trades, as stored in the side column.
+BUY = 1
+SELL = -1
+
+TRADE_COLUMNS = (
+    ('timestamp', 'd'),
+    ('side', 'b'),
+    ('price', 'd'),
+    ('size', 'q'),
+)
+
+BUCKET_COLUMNS = (
+    ('timestamp', 'd'),
+    ('open', 'd'),
+    ('high', 'd'),
+    ('low', 'd'),
+    ('close', 'd'),
+    ('trades', 'q'),
+    ('volume', 'q'),
+    ('vwap', 'd'),
+    ('turnover', 'q'),
+)
+
+BIN_SIZES = {
+    '1m': timedelta(minutes=1),
+    '5m': timedelta(minutes=5),
+    '1h': timedelta(hours=1),
+    '1d': timedelta(days=1),
+}
+
+
+class Columns:
+
+    '''
+    Named arrays of equal length, one per column. Timestamps are epoch seconds.
+    Missing float values are NaN, missing integers 0.
+    '''
+
+    def __init__(self, columns):
+        self.names = [name for name, _ in columns]
+        self.typecodes = dict(columns)
+        for name, typecode in columns:
+            setattr(self, name, array(typecode))
+
+    def __len__(self):
+        return len(getattr(self, self.names[0]))
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def append_row(self, values):
+        for name in self.names:
+            value = values.get(name)
+            if value is None:
+                value = float('nan') if self.typecodes[name] == 'd' else 0
+            getattr(self, name).append(value)
+
+    def extend(self, other):
+        for name in self.names:
+            getattr(self, name).extend(getattr(other, name))
+
+    def memory_bytes(self):
+        return sum(getattr(self, name).itemsize * len(getattr(self, name)) for name in self.names)
+
+
+class RateLimiter:
+
+    '''Spaces out calls evenly, at most requests_per_minute of them, across threads.'''
+
+    def __init__(self, requests_per_minute):
+        self.interval_seconds = 60.0 / requests_per_minute
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def acquire(self):
+        with self.lock:
+            now = time.time()
+            wait_seconds = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval_seconds
+        if 0 < wait_seconds:
+            time.sleep(wait_seconds)
+
+
+class HistoryLoader:
+
+    # Rows per page. BitMEX returns at most 1000.
+    PAGE_SIZE = 1000
+    # Public endpoints allow 30 requests per minute without an API key, 120 with one.
+    REQUESTS_PER_MINUTE = 30
+
+    def __init__(self, rest_client, max_workers=4, requests_per_minute=None):
+        self.logger = logging.getLogger(__name__)
+
+        self.rest_client = rest_client
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(
+            requests_per_minute if requests_per_minute is not None else HistoryLoader.REQUESTS_PER_MINUTE
+        )
+
+    def load_trades(self, start_time, end_time, chunk=timedelta(hours=1)):
+        '''Public trades of the symbol from start_time until end_time (datetimes), oldest first.'''
+        def fetch(chunk_start, chunk_end, start):
+            return self.rest_client.get_public_trades(chunk_start, chunk_end, count=HistoryLoader.PAGE_SIZE, start=start)
+
+        def convert(row, columns):
+            columns.append_row({
+                'timestamp': timestamp_seconds(row['timestamp']),
+                'side': BUY if row['side'] == 'Buy' else SELL,
+                'price': row['price'],
+                'size': row['size']
+            })
+
+        return self.__load(TRADE_COLUMNS, start_time, end_time, chunk, fetch, convert)
+
+    def load_buckets(self, bin_size, start_time, end_time, chunk=None):
+        '''
+        Trade buckets of bin_size (1m, 5m, 1h or 1d) from start_time until end_time, oldest first.
+        A bucket is timestamped with the end of its interval.
+        '''
+        if bin_size not in BIN_SIZES:
+            raise ValueError("Unknown bin size: %s" % bin_size)
+        if chunk is None:
+            # One page per chunk.
+            chunk = BIN_SIZES[bin_size] * HistoryLoader.PAGE_SIZE
+
+        def fetch(chunk_start, chunk_end, start):
+            return self.rest_client.get_trade_buckets(
+                bin_size, chunk_start, chunk_end, count=HistoryLoader.PAGE_SIZE, start=start
+            )
+
+        def convert(row, columns):
+            values = dict(row)
+            values['timestamp'] = timestamp_seconds(row['timestamp'])
+            columns.append_row(values)
+
+        return self.__load(BUCKET_COLUMNS, start_time, end_time, chunk, fetch, convert)
+
+    def __load(self, column_types, start_time, end_time, chunk, fetch, convert):
+        # Chunks don't overlap: each ends a millisecond before the next starts.
+        ranges = []
+        chunk_start = start_time
+        while chunk_start < end_time:
+            chunk_end = min(chunk_start + chunk, end_time)
+            last = chunk_end if chunk_end == end_time else chunk_end - timedelta(milliseconds=1)
+            ranges.append((_format_time(chunk_start), _format_time(last)))
+            chunk_start = chunk_end
+
+        def load_chunk(time_range):
+            columns = Columns(column_types)
+            start = 0
+            while True:
+                self.rate_limiter.acquire()
+                rows = fetch(time_range[0], time_range[1], start) or []
+                for row in rows:
+                    convert(row, columns)
+                if len(rows) < HistoryLoader.PAGE_SIZE:
+                    return columns
+                start += len(rows)
+
+        result = Columns(column_types)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for columns in executor.map(load_chunk, ranges):
+                result.extend(columns)
+        self.logger.debug("Loaded %d rows in %d chunks." % (len(result), len(ranges)))
+        return result
+
+
+def _format_time(dt):
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc)
+    return dt.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
@@ -0,0 +1,140 @@
+import json
+import logging
+import queue
+import threading
+
+
+# Decouples receiving websocket frames from applying them to the tables.
+#
+# The socket thread only enqueues raw frames. A single applier thread parses them and applies them
+# in order. When the applier falls behind, everything queued is drained at once and consecutive
+# updates of the same table are merged per row key, so a price level updated ten times is written once.
+# The queue is bounded: when it is full the socket thread blocks, which pushes back on the server
+# through TCP flow control instead of growing memory without limit.
+class IngestQueue:
+
+    # Don't drain more frames than this amount in one batch.
+    MAX_BATCH_LEN = 1000
+
+    def __init__(self, apply, keys, max_size=10000, max_batch_len=None):
+        '''
+        apply is called with each (possibly merged) parsed message, on the applier thread.
+        keys is the dict of table keys, as filled by the partials.
+        '''
+        self.logger = logging.getLogger(__name__)
+
+        self.apply = apply
+        self.keys = keys
+        self.max_batch_len = max_batch_len if max_batch_len is not None else IngestQueue.MAX_BATCH_LEN
+        self.queue = queue.Queue(maxsize=max_size)
+
+        self.received = 0
+        self.applied = 0
+        self.coalesced_rows = 0
+        self.blocked = 0
+        self.max_depth = 0
+
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            # Wake the applier up.
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+    def put(self, raw_message):
+        '''Called on the socket thread. Blocks while the queue is full.'''
+        self.received += 1
+        try:
+            self.queue.put_nowait(raw_message)
+        except queue.Full:
+            self.blocked += 1
+            self.queue.put(raw_message)
+        depth = self.queue.qsize()
+        if self.max_depth < depth:
+            self.max_depth = depth
+
+    def stats(self):
+        return {
+            'depth': self.queue.qsize(),
+            'maxDepth': self.max_depth,
+            'received': self.received,
+            'applied': self.applied,
+            'coalescedRows': self.coalesced_rows,
+            'blocked': self.blocked
+        }
+
+    def __run(self):
+        while self.running:
+            raw_messages = [self.queue.get()]
+            while len(raw_messages) < self.max_batch_len:
+                try:
+                    raw_messages.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            messages = []
+            for raw in raw_messages:
+                if raw is None:
+                    continue
+                try:
+                    messages.append(raw if isinstance(raw, dict) else json.loads(raw))
+                except ValueError:
+                    self.logger.error("Unparsable message: %s" % raw)
+
+            if 1 < len(messages):
+                messages, merged = coalesce_updates(messages, self.keys)
+                self.coalesced_rows += merged
+
+            for message in messages:
+                self.apply(message)
+                self.applied += 1
+
+
+def coalesce_updates(messages, keys):
+    '''
+    Merge runs of consecutive update messages of the same table into a single update message
+    carrying one row per key. Returns the new message list and the number of rows merged away.
+    Tables whose keys are not known yet are left untouched.
+    '''
+    result = []
+    runs = []
+    run_table = None
+    run_rows = None
+    merged = 0
+    for message in messages:
+        table = message.get('table')
+        if message.get('action') != 'update' or table not in keys:
+            run_table = None
+            result.append(message)
+            continue
+
+        table_keys = keys[table]
+        if run_table != table:
+            run_table = table
+            run_rows = {}
+            merged_message = {'table': table, 'action': 'update', 'data': []}
+            runs.append((merged_message, run_rows))
+            result.append(merged_message)
+
+        for row in message['data']:
+            key = tuple(row.get(k) for k in table_keys)
+            existing = run_rows.get(key)
+            if existing is None:
+                run_rows[key] = dict(row)
+            else:
+                existing.update(row)
+                merged += 1
+
+    for merged_message, rows in runs:
+        merged_message['data'] = list(rows.values())
+    return result, merged
@@ -60,3 +60,39 @@ class OpenOrders:
 
     def to_list(self):
         return self.bids + self.asks
+
+
+class Bar:
+
+    def __init__(self, start, end, open_price, high, low, close, volume, buy_volume, sell_volume, turnover, count):
+        self.start = start
+        self.end = end
+        self.open = open_price
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+        self.buy_volume = buy_volume
+        self.sell_volume = sell_volume
+        self.momentum = buy_volume - sell_volume
+        self.vwap = turnover / volume if volume else close
+        self.count = count
+
+    def __str__(self):
+        return str(self.to_dict())
+
+    def to_dict(self):
+        return {
+            'start': self.start,
+            'end': self.end,
+            'open': self.open,
+            'high': self.high,
+            'low': self.low,
+            'close': self.close,
+            'volume': self.volume,
+            'buyVolume': self.buy_volume,
+            'sellVolume': self.sell_volume,
+            'momentum': self.momentum,
+            'vwap': self.vwap,
+            'count': self.count
+        }
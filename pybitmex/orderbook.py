@@ -0,0 +1,295 @@
+import logging
+from array import array
+from math import gcd
+
+
+# Array-backed orderBookL2.
+#
+# BitMEX derives the id of an orderBookL2 level from its price:
+#   price = (base - id) * price_per_id
+# so the levels of an instrument are slots on a regular grid. Instead of one dict per level
+# we keep one size (8 bytes) and one side (1 byte) per slot, indexed by the id offset from the
+# first slot. Higher prices have lower ids, so sells come first and buys last.
+# The grid is laid out around the spread seen on the partial and capped to max_slots;
+# the few far away levels outside it (e.g. asks at absurd prices) are kept in a small dict.
+# The grid needs the prices of two levels. Until the partial or the inserts have given them,
+# levels are kept in that dict together with their prices.
+class DenseOrderBook:
+
+    BUY = 1
+    SELL = 2
+
+    # Don't lay out more slots than this amount. Helps cap memory usage.
+    MAX_SLOTS = 1000000
+
+    def __init__(self, symbol, max_slots=None):
+        self.logger = logging.getLogger(__name__)
+
+        self.symbol = symbol
+        self.max_slots = max_slots if max_slots is not None else DenseOrderBook.MAX_SLOTS
+        self.clear()
+
+    def clear(self):
+        # Grid parameters. Derived from the prices of the levels.
+        self.calibrated = False
+        self.stride = 1
+        self.price_per_id = None
+        self.base = 0
+        self.first_id = 0
+        self.low_limit = 0
+        self.high_limit = -1
+
+        self.sizes = array('q')
+        self.sides = bytearray()
+        # id -> [side, size] for the levels outside the grid.
+        self.overflow = {}
+        # id -> price of the levels in overflow, before the grid is calibrated.
+        self.prices = {}
+        self.level_count = 0
+
+    def __len__(self):
+        return self.level_count
+
+    def apply(self, action, rows):
+        if action == 'partial':
+            self.partial(rows)
+        elif action == 'insert':
+            self.insert(rows)
+        elif action == 'update':
+            self.update(rows)
+        elif action == 'delete':
+            self.delete(rows)
+        else:
+            raise Exception("Unknown action: %s" % action)
+
+    def partial(self, rows):
+        self.clear()
+        self.__lay_out(rows, sorted(set(r['id'] for r in rows)))
+
+    def __lay_out(self, rows, ids):
+        if len(ids) < 2:
+            # Not enough to lay out the grid. Keep the levels with their prices and wait for more.
+            self.clear()
+            self.insert(rows)
+            return
+        first = min(rows, key=lambda r: r['id'])
+        last = max(rows, key=lambda r: r['id'])
+        stride = 0
+        for i in range(1, len(ids)):
+            stride = gcd(stride, ids[i] - ids[0])
+        self.stride = stride
+        self.price_per_id = (float(first['price']) - float(last['price'])) / (last['id'] - first['id'])
+        self.base = round(first['id'] + float(first['price']) / self.price_per_id)
+        self.calibrated = True
+        self.overflow = {}
+        self.prices = {}
+        self.level_count = 0
+
+        # Center the grid on the spread.
+        sell_ids = [r['id'] for r in rows if r['side'] == 'Sell']
+        buy_ids = [r['id'] for r in rows if r['side'] == 'Buy']
+        if sell_ids and buy_ids:
+            center = (max(sell_ids) + min(buy_ids)) // 2
+        else:
+            center = (ids[0] + ids[-1]) // 2
+        center = ids[0] + ((center - ids[0]) // self.stride) * self.stride
+        half = (self.max_slots // 2) * self.stride
+        self.low_limit = center - half
+        self.high_limit = center + half
+
+        self.first_id = max(ids[0], self.low_limit)
+        last_id = min(ids[-1], self.high_limit)
+        slot_count = (last_id - self.first_id) // self.stride + 1
+        self.sizes = array('q', bytes(8 * slot_count))
+        self.sides = bytearray(slot_count)
+
+        self.insert(rows)
+
+    def insert(self, rows):
+        if not self.calibrated:
+            for r in rows:
+                if r['id'] not in self.overflow:
+                    self.level_count += 1
+                self.overflow[r['id']] = [DenseOrderBook.BUY if r['side'] == 'Buy' else DenseOrderBook.SELL, r['size']]
+                self.prices[r['id']] = float(r['price'])
+            if 1 < len(self.prices):
+                levels = self.to_rows()
+                self.__lay_out(levels, [r['id'] for r in levels])
+            return
+
+        for i, r in enumerate(rows):
+            if (r['id'] - self.first_id) % self.stride and self.low_limit <= r['id'] <= self.high_limit:
+                # Off the grid: the stride seen so far was too coarse. Lay the grid out again, finer.
+                levels = [level for level in self.to_rows() if level['id'] != r['id']] + [r]
+                self.__lay_out(levels, sorted(level['id'] for level in levels))
+                # The grid may be gone, if r was the only level left.
+                self.insert(rows[i + 1:])
+                return
+            side = DenseOrderBook.BUY if r['side'] == 'Buy' else DenseOrderBook.SELL
+            slot = self.__slot(r['id'], grow=True)
+            if 0 <= slot:
+                if not self.sides[slot]:
+                    self.level_count += 1
+                self.sides[slot] = side
+                self.sizes[slot] = r['size']
+            else:
+                if r['id'] not in self.overflow:
+                    self.level_count += 1
+                self.overflow[r['id']] = [side, r['size']]
+
+    def update(self, rows):
+        for r in rows:
+            slot = self.__slot(r['id'])
+            if 0 <= slot and self.sides[slot]:
+                if 'size' in r:
+                    self.sizes[slot] = r['size']
+                if 'side' in r:
+                    self.sides[slot] = DenseOrderBook.BUY if r['side'] == 'Buy' else DenseOrderBook.SELL
+            elif r['id'] in self.overflow:
+                level = self.overflow[r['id']]
+                if 'size' in r:
+                    level[1] = r['size']
+                if 'side' in r:
+                    level[0] = DenseOrderBook.BUY if r['side'] == 'Buy' else DenseOrderBook.SELL
+            else:
+                self.logger.debug('No level to update for %s', r)
+
+    def delete(self, rows):
+        for r in rows:
+            slot = self.__slot(r['id'])
+            if 0 <= slot and self.sides[slot]:
+                self.sides[slot] = 0
+                self.sizes[slot] = 0
+                self.level_count -= 1
+            elif self.overflow.pop(r['id'], None) is not None:
+                self.prices.pop(r['id'], None)
+                self.level_count -= 1
+
+    def price_of(self, level_id):
+        if not self.calibrated:
+            return self.prices[level_id]
+        return round((self.base - level_id) * self.price_per_id, 8)
+
+    def id_of(self, price):
+        return int(round(self.base - price / self.price_per_id))
+
+    def best_bid(self):
+        '''Return the best bid as {"price", "size"}, or None.'''
+        levels = self.bids(1)
+        return levels[0] if levels else None
+
+    def best_ask(self):
+        '''Return the best ask as {"price", "size"}, or None.'''
+        levels = self.asks(1)
+        return levels[0] if levels else None
+
+    def bids(self, depth=None):
+        '''Return bids as [{"price", "size"}], best first.'''
+        return self.__levels(DenseOrderBook.BUY, depth)
+
+    def asks(self, depth=None):
+        '''Return asks as [{"price", "size"}], best first.'''
+        return self.__levels(DenseOrderBook.SELL, depth)
+
+    def liquidity(self, side, price_limit):
+        '''Total size of the levels of side ("Buy" or "Sell") priced at price_limit or better.'''
+        if not self.calibrated:
+            code = DenseOrderBook.BUY if side == 'Buy' else DenseOrderBook.SELL
+            return sum(size for level_id, (level_side, size) in self.overflow.items() if level_side == code and
+                       (price_limit <= self.prices[level_id] if side == 'Buy' else self.prices[level_id] <= price_limit))
+        limit_id = self.id_of(price_limit)
+        slot_count = len(self.sides)
+        if side == 'Buy':
+            # Better bids have higher prices, that is lower ids.
+            code = DenseOrderBook.BUY
+            begin = 0
+            end = min(max((limit_id - self.first_id) // self.stride + 1, 0), slot_count)
+            in_range = lambda i: i <= limit_id
+        else:
+            code = DenseOrderBook.SELL
+            begin = min(max(-((self.first_id - limit_id) // self.stride), 0), slot_count)
+            end = slot_count
+            in_range = lambda i: limit_id <= i
+
+        sides = self.sides
+        sizes = self.sizes
+        total = 0
+        slot = sides.find(code, begin, end)
+        while 0 <= slot:
+            total += sizes[slot]
+            slot = sides.find(code, slot + 1, end)
+        for level_id, (level_side, size) in self.overflow.items():
+            if level_side == code and in_range(level_id):
+                total += size
+        return total
+
+    def to_rows(self):
+        '''Return the levels as orderBookL2 rows, lowest id first.'''
+        rows = []
+        for slot, side in enumerate(self.sides):
+            if side:
+                level_id = self.first_id + slot * self.stride
+                rows.append(self.__row(level_id, side, self.sizes[slot]))
+        for level_id, (side, size) in self.overflow.items():
+            rows.append(self.__row(level_id, side, size))
+        rows.sort(key=lambda r: r['id'])
+        return rows
+
+    def memory_bytes(self):
+        return self.sizes.itemsize * len(self.sizes) + len(self.sides) + 100 * len(self.overflow)
+
+    def __row(self, level_id, side, size):
+        return {
+            'symbol': self.symbol,
+            'id': level_id,
+            'side': 'Buy' if side == DenseOrderBook.BUY else 'Sell',
+            'size': size,
+            'price': self.price_of(level_id)
+        }
+
+    def __levels(self, code, depth):
+        sides = self.sides
+        sizes = self.sizes
+        result = []
+        if code == DenseOrderBook.BUY:
+            # Best bid is the lowest buy id.
+            slot = sides.find(code)
+            while 0 <= slot and (depth is None or len(result) < depth):
+                result.append({"price": self.price_of(self.first_id + slot * self.stride), "size": sizes[slot]})
+                slot = sides.find(code, slot + 1)
+        else:
+            # Best ask is the highest sell id.
+            slot = sides.rfind(code)
+            while 0 <= slot and (depth is None or len(result) < depth):
+                result.append({"price": self.price_of(self.first_id + slot * self.stride), "size": sizes[slot]})
+                slot = sides.rfind(code, 0, slot)
+
+        if self.overflow:
+            result += [{"price": self.price_of(level_id), "size": size}
+                       for level_id, (side, size) in self.overflow.items() if side == code]
+            result.sort(key=lambda level: level["price"], reverse=(code == DenseOrderBook.BUY))
+            if depth is not None:
+                result = result[:depth]
+        return result
+
+    def __slot(self, level_id, grow=False):
+        '''Return the slot of the id, or -1 if it is off the grid.'''
+        offset = level_id - self.first_id
+        if offset % self.stride:
+            return -1
+        slot = offset // self.stride
+        if 0 <= slot < len(self.sides):
+            return slot
+        if not grow or not (self.low_limit <= level_id <= self.high_limit):
+            return -1
+
+        if slot < 0:
+            # Prepend slots. Rare: only when the book extends beyond the partial.
+            self.sizes[0:0] = array('q', bytes(8 * -slot))
+            self.sides[0:0] = bytearray(-slot)
+            self.first_id = level_id
+            return 0
+        extra = slot - len(self.sides) + 1
+        self.sizes.extend(array('q', bytes(8 * extra)))
+        self.sides.extend(bytearray(extra))
+        return slot
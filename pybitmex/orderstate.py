@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+
+# Statuses after which an order is no longer open.
+CLOSED_STATUSES = ('Filled', 'Canceled', 'Rejected')
+
+
+# Orders we have sent but the order table doesn't show yet, and cancels it doesn't reflect yet.
+#
+# Orders are recorded as pending when they are submitted, keyed by clOrdID, and get their orderID
+# from the REST response. They stop being pending as soon as the order table shows their clOrdID.
+# Cancels are pending until the order table shows the order closed.
+# Anything the order table never confirms is forgotten after pending_timeout_seconds.
+class OrderStateBook:
+
+    def __init__(self, pending_timeout_seconds=10, clock=None):
+        '''clock returns the current time in epoch seconds, e.g. a simulated one in backtests. Defaults to time.time.'''
+        self.logger = logging.getLogger(__name__)
+
+        self.pending_timeout_seconds = pending_timeout_seconds
+        self.clock = clock if clock is not None else time.time
+        self.lock = threading.Lock()
+        # clOrdID -> (order row, time of submission)
+        self.pending_orders = {}
+        # orderID or clOrdID -> time of submission
+        self.pending_cancels = {}
+        # Bumped on every change, for memoized views.
+        self.version = 0
+
+    def add_pending_orders(self, orders):
+        '''Record orders being submitted. Each must have its clOrdID set. Market orders, which never rest, are skipped.'''
+        now = self.clock()
+        timestamp = datetime.fromtimestamp(now, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+        with self.lock:
+            for order in orders:
+                if order.get('ordType') == 'Market' or (order.get('price') is None and order.get('stopPx') is None):
+                    continue
+                row = {
+                    'orderID': None,
+                    'clOrdID': order['clOrdID'],
+                    'symbol': order.get('symbol'),
+                    'side': order['side'],
+                    'orderQty': order['orderQty'],
+                    'price': order.get('price'),
+                    'leavesQty': order['orderQty'],
+                    'cumQty': 0,
+                    'ordStatus': 'PendingNew',
+                    'timestamp': timestamp
+                }
+                self.pending_orders[order['clOrdID']] = (row, now)
+            self.version += 1
+
+    def on_orders_placed(self, response_rows):
+        '''Take the orderIDs and statuses from the REST response.'''
+        with self.lock:
+            for row in response_rows or []:
+                entry = self.pending_orders.get(row.get('clOrdID'))
+                if entry is None:
+                    continue
+                if row.get('ordStatus') in CLOSED_STATUSES:
+                    del self.pending_orders[row['clOrdID']]
+                else:
+                    entry[0]['orderID'] = row.get('orderID')
+            self.version += 1
+
+    def discard_pending_orders(self, client_order_ids):
+        '''Forget orders whose submission failed.'''
+        with self.lock:
+            for client_order_id in client_order_ids:
+                self.pending_orders.pop(client_order_id, None)
+            self.version += 1
+
+    def add_pending_cancels(self, order_ids):
+        now = self.clock()
+        with self.lock:
+            for order_id in order_ids:
+                self.pending_cancels[order_id] = now
+            self.version += 1
+
+    def discard_pending_cancels(self, order_ids):
+        '''Forget cancels whose submission failed.'''
+        with self.lock:
+            for order_id in order_ids:
+                self.pending_cancels.pop(order_id, None)
+            self.version += 1
+
+    def on_message(self, table, action, rows):
+        '''Listener for the order table.'''
+        with self.lock:
+            changed = False
+            for row in rows:
+                if self.pending_orders.pop(row.get('clOrdID'), None) is not None:
+                    changed = True
+                if row.get('ordStatus') in CLOSED_STATUSES:
+                    for key in (row.get('orderID'), row.get('clOrdID')):
+                        if self.pending_cancels.pop(key, None) is not None:
+                            changed = True
+            if changed:
+                self.version += 1
+
+    def merge(self, open_order_rows):
+        '''Return the open orders as we intend them: the order table rows, plus pending orders, minus pending cancels.'''
+        with self.lock:
+            if not self.pending_orders and not self.pending_cancels:
+                return open_order_rows
+            client_order_ids = set(o['clOrdID'] for o in open_order_rows)
+            result = [o for o in open_order_rows
+                      if o['orderID'] not in self.pending_cancels and o['clOrdID'] not in self.pending_cancels]
+            for client_order_id, (row, _) in self.pending_orders.items():
+                if client_order_id in client_order_ids or client_order_id in self.pending_cancels or \
+                        row['orderID'] in self.pending_cancels:
+                    continue
+                result.append(row)
+            return result
+
+    def expire(self):
+        '''Forget what has been pending for longer than pending_timeout_seconds.'''
+        with self.lock:
+            self.__expire()
+
+    def __expire(self):
+        deadline = self.clock() - self.pending_timeout_seconds
+        expired_orders = [k for k, (_, t) in self.pending_orders.items() if t < deadline]
+        expired_cancels = [k for k, t in self.pending_cancels.items() if t < deadline]
+        for k in expired_orders:
+            self.logger.warning("Order %s was never confirmed by the order table." % k)
+            del self.pending_orders[k]
+        for k in expired_cancels:
+            del self.pending_cancels[k]
+        if expired_orders or expired_cancels:
+            self.version += 1
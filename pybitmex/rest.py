@@ -1,5 +1,6 @@
 import time
 import json
+import threading
 
 import logging
 
@@ -7,6 +8,7 @@ import base64
 import uuid
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from pybitmex.auth import APIKeyAuthWithExpires
 
@@ -30,6 +32,48 @@ class RestClientError(Exception):
         return 500 <= self.error_code < 600
 
 
+class ConnectionStats:
+
+    """Counts, per request path, how many requests reused a pooled connection and how many opened a new one."""
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.per_path = {}
+
+    def track(self, pool_manager):
+        """Make the connections of the pools of the urllib3 pool manager report when they (re)connect."""
+        local = self.local
+
+        def tracked_connection_class(base):
+            def connect(conn):
+                local.connected = True
+                base.connect(conn)
+            return type('Tracked' + base.__name__, (base,), {'connect': connect})
+
+        pool_manager.pool_classes_by_scheme = {
+            scheme: type('Tracked' + pool_class.__name__, (pool_class,),
+                         {'ConnectionCls': tracked_connection_class(pool_class.ConnectionCls)})
+            for scheme, pool_class in pool_manager.pool_classes_by_scheme.items()
+        }
+
+    def begin(self):
+        self.local.connected = False
+
+    def end(self, path):
+        """Record the request that just completed on this thread. Returns True if it reused a connection."""
+        reused = not getattr(self.local, 'connected', False)
+        with self.lock:
+            stats = self.per_path.setdefault(path, {'requests': 0, 'reused': 0, 'new': 0})
+            stats['requests'] += 1
+            stats['reused' if reused else 'new'] += 1
+        return reused
+
+    def to_dict(self):
+        with self.lock:
+            return {path: dict(stats) for path, stats in self.per_path.items()}
+
+
 class RestClient:
 
     def __init__(
@@ -38,8 +82,19 @@ class RestClient:
             order_id_prefix="",
             agent_name="trading_bot",
             timeout=7,
-            expiration_seconds=3600
+            expiration_seconds=3600,
+            pool_connections=10,
+            pool_maxsize=10,
+            warm_up_connections=0,
+            keep_alive_interval_seconds=None
     ):
+        """
+        pool_connections and pool_maxsize size the HTTP connection pool (see requests.adapters.HTTPAdapter).
+        warm_up_connections: open this many connections right away, so that the first orders don't pay
+        for the TCP and TLS handshakes.
+        keep_alive_interval_seconds: when no request has been sent for this long, ping the server
+        to keep the pooled connections open.
+        """
         self.logger = logging.getLogger(__name__)
 
         self.base_url = uri
@@ -56,15 +111,66 @@ class RestClient:
         self.session.headers.update({'content-type': 'application/json'})
         self.session.headers.update({'accept': 'application/json'})
 
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+        self.connection_stats = ConnectionStats()
+        self.connection_stats.track(self.adapter.poolmanager)
+
         self.timeout = timeout
         self.expiration_seconds = expiration_seconds
-        self.retries = 0
+        self.last_request_time = time.time()
+        self.closed = False
+
+        if 0 < warm_up_connections:
+            self.warm_up(warm_up_connections)
+
+        self.keep_alive_interval_seconds = keep_alive_interval_seconds
+        self.keep_alive_connections = max(warm_up_connections, 1)
+        if keep_alive_interval_seconds:
+            self.keep_alive_thread = threading.Thread(target=self.__keep_alive)
+            self.keep_alive_thread.daemon = True
+            self.keep_alive_thread.start()
+        else:
+            self.keep_alive_thread = None
 
     def close(self):
+        self.closed = True
         self.session.close()
 
-    def curl_bitmex(self, path, query=None, postdict=None, timeout=None, verb=None, max_retries=None):
-        """Send a request to BitMEX Servers."""
+    def get_connection_stats(self):
+        """Requests per path, and how many of them reused a connection or opened a new one."""
+        return self.connection_stats.to_dict()
+
+    def warm_up(self, connections=1):
+        """Open connections to the server concurrently, so that they are pooled and ready."""
+        threads = [threading.Thread(target=self.__ping) for _ in range(connections)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    def __ping(self):
+        try:
+            self.connection_stats.begin()
+            # Sent the way curl_bitmex sends, so that it goes through the same pool.
+            prepped = self.session.prepare_request(requests.Request('HEAD', self.base_url))
+            self.session.send(prepped, timeout=self.timeout)
+            self.connection_stats.end('(ping)')
+        except requests.exceptions.RequestException as e:
+            self.logger.warning("Ping failed: %s", e)
+
+    def __keep_alive(self):
+        while not self.closed:
+            idle_seconds = time.time() - self.last_request_time
+            if self.keep_alive_interval_seconds <= idle_seconds:
+                self.last_request_time = time.time()
+                self.warm_up(self.keep_alive_connections)
+                idle_seconds = 0
+            time.sleep(self.keep_alive_interval_seconds - idle_seconds)
+
+    def curl_bitmex(self, path, query=None, postdict=None, timeout=None, verb=None, max_retries=None, retries=0):
+        """Send a request to BitMEX Servers. retries is how many times this request has been retried so far."""
         # Handle URL
         uri = self.base_url + path
 
@@ -82,23 +188,26 @@ class RestClient:
         if max_retries is None:
             max_retries = 0 if verb in ['POST', 'PUT'] else 3
 
-        # Auth: API Key/Secret
-        auth = APIKeyAuthWithExpires(self.api_key, self.api_secret, self.expiration_seconds)
+        # Auth: API Key/Secret. Public endpoints can be requested without them.
+        if self.api_key is not None:
+            auth = APIKeyAuthWithExpires(self.api_key, self.api_secret, self.expiration_seconds)
+        else:
+            auth = None
 
         def rethrow(message_str, code):
             raise RestClientError(message_str, code)
 
+        # Counted per request, as several threads may share this client.
         def retry(sleep_seconds, code):
-            self.retries += 1
-            if max_retries < self.retries:
+            if max_retries < retries + 1:
                 rethrow("Max retries on {} {} hit.".format(verb, uri), code)
 
             if 0 <= sleep_seconds:
                 seconds_to_sleep = sleep_seconds
             else:
-                seconds_to_sleep = self.retries
+                seconds_to_sleep = retries + 1
             time.sleep(seconds_to_sleep)
-            return self.curl_bitmex(path, query, postdict, timeout, verb, max_retries)
+            return self.curl_bitmex(path, query, postdict, timeout, verb, max_retries, retries + 1)
 
         # Make the request
         response = None
@@ -106,12 +215,15 @@ class RestClient:
             self.logger.info("Requesting %s to %s", verb, uri)
             req = requests.Request(verb, uri, json=postdict, auth=auth, params=query)
             prepped = self.session.prepare_request(req)
-            response = self.session.send(prepped, timeout=timeout)
+            self.connection_stats.begin()
+            self.last_request_time = time.time()
+            try:
+                response = self.session.send(prepped, timeout=timeout)
+            finally:
+                if not self.connection_stats.end(verb + ' ' + path.split('?')[0]):
+                    self.logger.info("%s %s opened a new connection.", verb, uri)
             # Make non-200s throw
             response.raise_for_status()
-
-            # Reset retry counter on success
-            self.retries = 0
             return response.json()
         except requests.exceptions.HTTPError as e:
             if response is None:
@@ -176,12 +288,26 @@ class RestClient:
         path = 'user/margin'
         return self.curl_bitmex(path=path, verb='GET')
 
+    def get_public_trades(self, start_time, end_time, count=1000, start=0):
+        """One page of the public trades of the symbol between start_time and end_time (ISO 8601 strings), oldest first."""
+        path = 'trade?symbol={}&count={:d}&start={:d}&reverse=false'.format(self.symbol, count, start) +\
+               '&startTime=' + start_time + '&endTime=' + end_time
+        return self.curl_bitmex(path=path, verb='GET')
+
+    def get_trade_buckets(self, bin_size, start_time, end_time, count=1000, start=0):
+        """One page of the trade buckets (1m, 5m, 1h or 1d) of the symbol, oldest first."""
+        path = 'trade/bucketed?binSize={}&partial=false&symbol={}&count={:d}&start={:d}&reverse=false'.format(
+            bin_size, self.symbol, count, start) + '&startTime=' + start_time + '&endTime=' + end_time
+        return self.curl_bitmex(path=path, verb='GET')
+
+    def new_client_order_id(self):
+        return self.order_id_prefix + base64.b64encode(uuid.uuid4().bytes).decode('utf8').rstrip('=\n')
+
     def place_orders(self, orders, post_only=True, max_retries=None):
         """Create multiple orders."""
         for order in orders:
             if order.get('clOrdID') is None:
-                order['clOrdID'] = self.order_id_prefix +\
-                                   base64.b64encode(uuid.uuid4().bytes).decode('utf8').rstrip('=\n')
+                order['clOrdID'] = self.new_client_order_id()
             order['symbol'] = self.symbol
             if post_only:
                 order['execInst'] = 'ParticipateDoNotInitiate'
@@ -189,8 +315,7 @@ class RestClient:
 
     def market_close_position(self, order, max_retries=None):
         if order.get('clOrdID') is None:
-            order['clOrdID'] = self.order_id_prefix + \
-                               base64.b64encode(uuid.uuid4().bytes).decode('utf8').rstrip('=\n')
+            order['clOrdID'] = self.new_client_order_id()
         order['symbol'] = self.symbol
         order['ordType'] = 'Market'
         order['execInst'] = 'Close'
@@ -203,3 +328,11 @@ class RestClient:
             'orderID': order_id_list,
         }
         return self.curl_bitmex(path=path, postdict=postdict, verb="DELETE", max_retries=max_retries)
+
+    def cancel_orders_by_client_order_id(self, client_order_id_list, max_retries=None):
+        """Cancel orders by clOrdID, e.g. ones whose orderID we don't know yet."""
+        path = "order"
+        postdict = {
+            'clOrdID': client_order_id_list,
+        }
+        return self.curl_bitmex(path=path, postdict=postdict, verb="DELETE", max_retries=max_retries)
@@ -0,0 +1,527 @@
+import json
+import logging
+import math
+import struct
+import threading
+from datetime import datetime, timezone
+from multiprocessing import resource_tracker, shared_memory
+from time import sleep
+
+from pybitmex.cache import ViewCache
+from pybitmex.timestamps import NS_FIELD, timestamp_ns
+from pybitmex.ws import PUBLIC_TABLES, ORDER_BOOK_TABLES
+
+
+# Shares the public market data of one websocket connection with other processes on the same host.
+#
+# The publisher writes the public tables into a shared memory segment in a fixed binary layout,
+# which readers index in place: they unpack only the records they are asked for, and keep no copy of the book.
+#
+#   sequence                                    guards everything below, as a seqlock
+#   layout    symbol and section capacities     written once
+#   state     order book table, record counts
+#   tables    version and update time per public table
+#   bids      price levels, best first          LEVEL records
+#   asks      price levels, best first          LEVEL records
+#   trades    ring of the latest trades         TRADE records
+#   quotes    ring of the latest quotes         QUOTE records
+#   instrument                                  JSON of the instrument row, which has too many fields to lay out
+#
+# The writer makes the sequence odd while it writes and even again when done, and a reader retries
+# whenever it sees an odd sequence or the sequence moved while it was reading.
+# There is a single writer, so no lock is shared between processes.
+SEQUENCE = struct.Struct('<Q')
+# symbol, max levels per side, trade capacity, quote capacity, instrument capacity in bytes
+LAYOUT = struct.Struct('<16sIIII')
+# order book table, bid count, ask count, trades written, quotes written, instrument length
+STATE = struct.Struct('<16sIIQQI')
+# version, update time in epoch nanoseconds
+TABLE_STATE = struct.Struct('<Qq')
+# id, price, size
+LEVEL = struct.Struct('<qdq')
+# timestamp in epoch nanoseconds, side (1 for Buy, -1 for Sell), price, size, trdMatchID
+TRADE = struct.Struct('<qbdq36s')
+# timestamp in epoch nanoseconds, bid price, bid size, ask price, ask size
+QUOTE = struct.Struct('<qdqdq')
+
+
+class _Layout:
+
+    '''Offsets of the sections of a segment.'''
+
+    def __init__(self, max_levels, trade_capacity, quote_capacity, instrument_capacity):
+        self.max_levels = max_levels
+        self.trade_capacity = trade_capacity
+        self.quote_capacity = quote_capacity
+        self.instrument_capacity = instrument_capacity
+
+        self.layout_offset = SEQUENCE.size
+        self.state_offset = self.layout_offset + LAYOUT.size
+        self.tables_offset = self.state_offset + STATE.size
+        self.bids_offset = self.tables_offset + TABLE_STATE.size * len(PUBLIC_TABLES)
+        self.asks_offset = self.bids_offset + LEVEL.size * max_levels
+        self.trades_offset = self.asks_offset + LEVEL.size * max_levels
+        self.quotes_offset = self.trades_offset + TRADE.size * trade_capacity
+        self.instrument_offset = self.quotes_offset + QUOTE.size * quote_capacity
+        self.size = self.instrument_offset + instrument_capacity
+
+
+def _float(value):
+    return float('nan') if value is None else float(value)
+
+
+def _optional(value):
+    return None if math.isnan(value) else value
+
+
+def _iso(ns):
+    return datetime.fromtimestamp(ns // 1000000 / 1000, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def _row_ns(row):
+    ns = row.get(NS_FIELD)
+    if ns is None and row.get('timestamp') is not None:
+        ns = timestamp_ns(row['timestamp'])
+    return ns or 0
+
+
+class SharedMarketDataPublisher:
+
+    # Don't share more price levels per side than this amount.
+    MAX_LEVELS = 20000
+    # Latest trades and quotes kept, as many as the websocket client keeps.
+    TRADE_CAPACITY = 200
+    QUOTE_CAPACITY = 200
+    INSTRUMENT_CAPACITY = 64 * 1024
+
+    def __init__(self, name, ws_client, max_levels=None, publish_interval_seconds=0.1):
+        '''Create the segment and publish the public tables of ws_client at most every publish_interval_seconds.'''
+        self.logger = logging.getLogger(__name__)
+
+        self.ws_client = ws_client
+        self.publish_interval_seconds = publish_interval_seconds
+        self.layout = _Layout(
+            max_levels if max_levels is not None else SharedMarketDataPublisher.MAX_LEVELS,
+            SharedMarketDataPublisher.TRADE_CAPACITY,
+            SharedMarketDataPublisher.QUOTE_CAPACITY,
+            SharedMarketDataPublisher.INSTRUMENT_CAPACITY
+        )
+        self.segment = shared_memory.SharedMemory(name=name, create=True, size=self.layout.size)
+        buf = self.segment.buf
+        SEQUENCE.pack_into(buf, 0, 0)
+        LAYOUT.pack_into(buf, self.layout.layout_offset, ws_client.symbol.encode('utf-8'), self.layout.max_levels,
+                         self.layout.trade_capacity, self.layout.quote_capacity, self.layout.instrument_capacity)
+        self.sequence = 0
+
+        # Sections are only rewritten when their table changed.
+        self.published_versions = {}
+        self.bid_count = 0
+        self.ask_count = 0
+        self.instrument_length = 0
+        self.trades_written = 0
+        self.quotes_written = 0
+        # Rows inserted since the last publication, appended to the rings.
+        self.lock = threading.Lock()
+        self.new_trades = []
+        self.new_quotes = []
+
+        self.dirty = True
+        self.exited = False
+        for table in PUBLIC_TABLES:
+            ws_client.add_listener(table, self.__on_message)
+        # What the tables held before we listened.
+        self.__on_message('trade', 'partial', list(ws_client.data.get('trade', [])))
+        self.__on_message('quote', 'partial', list(ws_client.data.get('quote', [])))
+
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def exit(self):
+        self.exited = True
+        for table in PUBLIC_TABLES:
+            self.ws_client.remove_listener(table, self.__on_message)
+        self.thread.join()
+        self.segment.close()
+        self.segment.unlink()
+
+    def publish(self):
+        '''Write what changed in the public tables into the segment.'''
+        self.dirty = False
+        ws_client = self.ws_client
+        layout = self.layout
+        versions = dict(ws_client.versions)
+        order_book_table = ws_client.get_order_book_table_name()
+
+        # Gather everything first, so that the segment is odd for as short as possible.
+        levels = None
+        book_version = (order_book_table, versions.get(order_book_table))
+        if order_book_table in ws_client.data and self.published_versions.get('book') != book_version:
+            levels = self.__levels(order_book_table)
+        instrument = None
+        if self.published_versions.get('instrument') != versions.get('instrument') and ws_client.data.get('instrument'):
+            # default=dict serializes compact rows.
+            instrument = json.dumps(ws_client.data['instrument'][0], separators=(',', ':'), default=dict).encode('utf-8')
+            if layout.instrument_capacity < len(instrument):
+                self.logger.error("Instrument of %d bytes does not fit in the shared memory segment." % len(instrument))
+                instrument = None
+        with self.lock:
+            new_trades, self.new_trades = self.new_trades, []
+            new_quotes, self.new_quotes = self.new_quotes, []
+
+        buf = self.segment.buf
+        self.sequence += 1
+        SEQUENCE.pack_into(buf, 0, self.sequence)
+
+        if levels is not None:
+            bids, asks = levels
+            self.bid_count = self.__write_levels(buf, layout.bids_offset, bids)
+            self.ask_count = self.__write_levels(buf, layout.asks_offset, asks)
+            self.published_versions['book'] = book_version
+        if instrument is not None:
+            buf[layout.instrument_offset:layout.instrument_offset + len(instrument)] = instrument
+            self.instrument_length = len(instrument)
+            self.published_versions['instrument'] = versions.get('instrument')
+        for row in new_trades:
+            TRADE.pack_into(buf, layout.trades_offset + TRADE.size * (self.trades_written % layout.trade_capacity),
+                            _row_ns(row), 1 if row.get('side') == 'Buy' else -1, _float(row.get('price')),
+                            int(row.get('size') or 0), str(row.get('trdMatchID') or '').encode('utf-8'))
+            self.trades_written += 1
+        for row in new_quotes:
+            QUOTE.pack_into(buf, layout.quotes_offset + QUOTE.size * (self.quotes_written % layout.quote_capacity),
+                            _row_ns(row), _float(row.get('bidPrice')), int(row.get('bidSize') or 0),
+                            _float(row.get('askPrice')), int(row.get('askSize') or 0))
+            self.quotes_written += 1
+        for i, table in enumerate(PUBLIC_TABLES):
+            update = ws_client.updates.get(table)
+            TABLE_STATE.pack_into(buf, layout.tables_offset + TABLE_STATE.size * i, versions.get(table, 0),
+                                  int(update.timestamp() * 1e9) if update is not None else 0)
+        STATE.pack_into(buf, layout.state_offset, order_book_table.encode('utf-8'), self.bid_count, self.ask_count,
+                        self.trades_written, self.quotes_written, self.instrument_length)
+
+        self.sequence += 1
+        SEQUENCE.pack_into(buf, 0, self.sequence)
+
+    def __levels(self, order_book_table):
+        '''(bids, asks) as (id, price, size) tuples, best first.'''
+        ws_client = self.ws_client
+        if order_book_table == 'orderBook10':
+            rows = ws_client.data[order_book_table]
+            if not rows:
+                return [], []
+            return ([(0, float(p), int(s)) for p, s in rows[0]['bids']],
+                    [(0, float(p), int(s)) for p, s in rows[0]['asks']])
+        dense_book = ws_client.dense_order_book()
+        rows = dense_book.to_rows() if dense_book is not None else list(ws_client.data[order_book_table])
+        bids = sorted([(r['id'], float(r['price']), int(r['size'])) for r in rows if r['side'] == 'Buy'],
+                      key=lambda level: level[1], reverse=True)
+        asks = sorted([(r['id'], float(r['price']), int(r['size'])) for r in rows if r['side'] == 'Sell'],
+                      key=lambda level: level[1])
+        return bids, asks
+
+    def __write_levels(self, buf, offset, levels):
+        if self.layout.max_levels < len(levels):
+            self.logger.warning("Sharing only the best %d of %d levels." % (self.layout.max_levels, len(levels)))
+            levels = levels[:self.layout.max_levels]
+        for i, level in enumerate(levels):
+            LEVEL.pack_into(buf, offset + LEVEL.size * i, *level)
+        return len(levels)
+
+    def __on_message(self, table, action, rows):
+        if action in ('partial', 'insert') and table in ('trade', 'quote'):
+            with self.lock:
+                (self.new_trades if table == 'trade' else self.new_quotes).extend(rows)
+        self.dirty = True
+
+    def __run(self):
+        while not self.exited:
+            if self.dirty:
+                try:
+                    self.publish()
+                except Exception:
+                    self.logger.exception('Failed to publish market data.')
+                    self.dirty = True
+            sleep(self.publish_interval_seconds)
+
+
+class SharedOrderBook:
+
+    '''
+    View of the order book of a segment, with the query methods of DenseOrderBook.
+    Each call reads the levels it needs from the segment.
+    '''
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        state = self.reader.read_state()
+        return state[1] + state[2]
+
+    def best_bid(self):
+        levels = self.bids(1)
+        return levels[0] if levels else None
+
+    def best_ask(self):
+        levels = self.asks(1)
+        return levels[0] if levels else None
+
+    def bids(self, depth=None):
+        '''Return bids as [{"price", "size"}], best first.'''
+        return [{"price": price, "size": size} for _, price, size in self.reader.read_levels('Buy', depth)]
+
+    def asks(self, depth=None):
+        '''Return asks as [{"price", "size"}], best first.'''
+        return [{"price": price, "size": size} for _, price, size in self.reader.read_levels('Sell', depth)]
+
+    def liquidity(self, side, price_limit):
+        '''Total size of the levels of side ("Buy" or "Sell") priced at price_limit or better.'''
+        total = 0
+        for _, price, size in self.reader.read_levels(side, None):
+            if (price < price_limit) if side == 'Buy' else (price_limit < price):
+                break
+            total += size
+        return total
+
+    def to_rows(self):
+        return self.reader.market_depth()
+
+
+class SharedMarketDataReader:
+
+    '''
+    Read side of SharedMarketDataPublisher.
+    Offers the public table accessors of BitMEXWebSocketClient, backed by the segment.
+    Listeners of the trade, quote and instrument tables are called from a polling thread.
+    The order book is published as a whole, so it has no listeners.
+    '''
+
+    def __init__(self, name, wait_seconds=30, poll_interval_seconds=0.01):
+        '''Attach to the segment and wait until the publisher has written to it.'''
+        self.logger = logging.getLogger(__name__)
+
+        self.segment = shared_memory.SharedMemory(name=name)
+        # Only the publisher owns the segment. Keep the resource tracker from unlinking it when we exit.
+        resource_tracker.unregister(self.segment._name, 'shared_memory')
+
+        waited = 0.0
+        while SEQUENCE.unpack_from(self.segment.buf, 0)[0] == 0:
+            if wait_seconds <= waited:
+                raise TimeoutError("No market data has been published to %s." % name)
+            sleep(0.1)
+            waited += 0.1
+
+        symbol, max_levels, trade_capacity, quote_capacity, instrument_capacity = \
+            LAYOUT.unpack_from(self.segment.buf, SEQUENCE.size)
+        self.symbol = symbol.rstrip(b'\0').decode('utf-8')
+        self.layout = _Layout(max_levels, trade_capacity, quote_capacity, instrument_capacity)
+        self.view_cache = ViewCache()
+        self.order_book = SharedOrderBook(self)
+
+        self.listeners = {}
+        self.poll_interval_seconds = poll_interval_seconds
+        self.poll_thread = None
+        self.exited = False
+
+    def exit(self):
+        self.exited = True
+        if self.poll_thread is not None:
+            self.poll_thread.join()
+        self.segment.close()
+
+    #
+    # Reads
+    #
+
+    def read(self, read_segment):
+        '''Call read_segment(buf) until it has read a consistent state of the segment. Returns what it returned.'''
+        buf = self.segment.buf
+        while True:
+            sequence = SEQUENCE.unpack_from(buf, 0)[0]
+            if sequence % 2:
+                # Being written.
+                sleep(0)
+                continue
+            try:
+                result = read_segment(buf)
+            except Exception:
+                if SEQUENCE.unpack_from(buf, 0)[0] == sequence:
+                    raise
+                continue
+            if SEQUENCE.unpack_from(buf, 0)[0] == sequence:
+                return result
+
+    def read_state(self):
+        '''(order book table, bid count, ask count, trades written, quotes written, instrument length)'''
+        state = self.read(lambda buf: STATE.unpack_from(buf, self.layout.state_offset))
+        return (state[0].rstrip(b'\0').decode('utf-8'),) + state[1:]
+
+    def read_levels(self, side, depth):
+        '''(id, price, size) tuples of side, best first.'''
+        layout = self.layout
+
+        def read_segment(buf):
+            state = STATE.unpack_from(buf, layout.state_offset)
+            count = state[1] if side == 'Buy' else state[2]
+            if depth is not None:
+                count = min(count, depth)
+            offset = layout.bids_offset if side == 'Buy' else layout.asks_offset
+            return [LEVEL.unpack_from(buf, offset + LEVEL.size * i) for i in range(count)]
+
+        return self.read(read_segment)
+
+    def read_trades(self, since=None):
+        '''(trades written, rows of the trades kept), only those written after since if given.'''
+        return self.__read_ring(3, self.layout.trades_offset, self.layout.trade_capacity, TRADE, since,
+                                self.__trade_row)
+
+    def read_quotes(self, since=None):
+        return self.__read_ring(4, self.layout.quotes_offset, self.layout.quote_capacity, QUOTE, since,
+                                self.__quote_row)
+
+    def __read_ring(self, count_index, offset, capacity, record, since, to_row):
+        layout = self.layout
+
+        def read_segment(buf):
+            written = STATE.unpack_from(buf, layout.state_offset)[count_index]
+            first = max(written - capacity, since if since is not None else 0)
+            return written, [record.unpack_from(buf, offset + record.size * (i % capacity)) for i in range(first, written)]
+
+        written, records = self.read(read_segment)
+        return written, [to_row(r) for r in records]
+
+    def __trade_row(self, record):
+        ns, side, price, size, trd_match_id = record
+        return {'timestamp': _iso(ns), NS_FIELD: ns, 'symbol': self.symbol, 'side': 'Buy' if side == 1 else 'Sell',
+                'size': size, 'price': price, 'trdMatchID': trd_match_id.rstrip(b'\0').decode('utf-8', 'replace')}
+
+    def __quote_row(self, record):
+        ns, bid_price, bid_size, ask_price, ask_size = record
+        return {'timestamp': _iso(ns), NS_FIELD: ns, 'symbol': self.symbol, 'bidSize': bid_size,
+                'bidPrice': _optional(bid_price), 'askPrice': _optional(ask_price), 'askSize': ask_size}
+
+    #
+    # The accessors of BitMEXWebSocketClient
+    #
+
+    @property
+    def versions(self):
+        return {table: version for table, (version, _) in self.__table_states().items()}
+
+    @property
+    def updates(self):
+        return {table: datetime.fromtimestamp(ns / 1e9, timezone.utc)
+                for table, (_, ns) in self.__table_states().items() if ns}
+
+    def __table_states(self):
+        layout = self.layout
+
+        def read_segment(buf):
+            return [TABLE_STATE.unpack_from(buf, layout.tables_offset + TABLE_STATE.size * i)
+                    for i in range(len(PUBLIC_TABLES))]
+
+        return dict(zip(PUBLIC_TABLES, self.read(read_segment)))
+
+    def get_order_book_table_name(self):
+        return self.read_state()[0]
+
+    def get_instrument(self):
+        '''Get the raw instrument data for this symbol. Decoded again only when it changed.'''
+        return self.view_cache.get('instrument', self.versions.get('instrument'), self.__read_instrument)
+
+    def __read_instrument(self):
+        layout = self.layout
+
+        def read_segment(buf):
+            length = STATE.unpack_from(buf, layout.state_offset)[5]
+            return json.loads(bytes(buf[layout.instrument_offset:layout.instrument_offset + length]).decode('utf-8'))
+
+        instrument = self.read(read_segment)
+        instrument['tickLog'] = int(math.fabs(math.log10(instrument['tickSize'])))
+        return instrument
+
+    def get_ticker(self):
+        '''Return a ticker object. Generated from quote and trade.'''
+        versions = self.versions
+        version_key = (versions.get('quote'), versions.get('trade'), versions.get('instrument'))
+        return self.view_cache.get('ticker', version_key, self.__compute_ticker)
+
+    def __compute_ticker(self):
+        last_quote = self.read_quotes()[1][-1]
+        last_trade = self.read_trades()[1][-1]
+        ticker = {
+            "last": last_trade['price'],
+            "buy": last_quote['bidPrice'],
+            "sell": last_quote['askPrice'],
+            "mid": (float(last_quote['bidPrice'] or 0) + float(last_quote['askPrice'] or 0)) / 2
+        }
+        tick_log = self.get_instrument()['tickLog']
+        return {k: round(float(v or 0), tick_log) for k, v in ticker.items()}
+
+    def market_depth(self):
+        '''Get market depth (orderbook) as rows of the order book table. Builds every level.'''
+        table = self.get_order_book_table_name()
+        bids = self.read_levels('Buy', None)
+        asks = self.read_levels('Sell', None)
+        if table == 'orderBook10':
+            return [{'symbol': self.symbol, 'bids': [[p, s] for _, p, s in bids], 'asks': [[p, s] for _, p, s in asks]}]
+        return [{'symbol': self.symbol, 'id': i, 'side': 'Sell', 'size': s, 'price': p} for i, p, s in reversed(asks)] + \
+               [{'symbol': self.symbol, 'id': i, 'side': 'Buy', 'size': s, 'price': p} for i, p, s in bids]
+
+    def dense_order_book(self):
+        '''The book, queried in place. See SharedOrderBook.'''
+        return self.order_book
+
+    def recent_trades(self):
+        return self.read_trades()[1]
+
+    #
+    # Listeners
+    #
+
+    def add_listener(self, table, callback):
+        '''Call callback(table, action, rows) from a polling thread for new trades, quotes and instrument updates.'''
+        if table not in ('trade', 'quote', 'instrument'):
+            raise ValueError("Shared market data has no listeners for the %s table." % table)
+        self.listeners.setdefault(table, []).append(callback)
+        if self.poll_thread is None:
+            self.poll_thread = threading.Thread(target=self.__poll)
+            self.poll_thread.daemon = True
+            self.poll_thread.start()
+
+    def remove_listener(self, table, callback):
+        callbacks = self.listeners.get(table, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+    def __poll(self):
+        sequence = None
+        trades_read = self.read_state()[3]
+        quotes_read = self.read_state()[4]
+        instrument_version = self.versions.get('instrument')
+        while not self.exited:
+            current = SEQUENCE.unpack_from(self.segment.buf, 0)[0]
+            if current == sequence:
+                sleep(self.poll_interval_seconds)
+                continue
+            sequence = current
+            try:
+                trades_written, trades = self.read_trades(trades_read)
+                if self.layout.trade_capacity < trades_written - trades_read:
+                    self.logger.warning("Missed %d trades." % (trades_written - trades_read - self.layout.trade_capacity))
+                trades_read = trades_written
+                quotes_read, quotes = self.read_quotes(quotes_read)
+                version = self.versions.get('instrument')
+                instrument = self.get_instrument() if version != instrument_version else None
+                instrument_version = version
+            except Exception:
+                self.logger.exception('Failed to read market data.')
+                continue
+            for table, rows in (('trade', trades), ('quote', quotes), ('instrument', [instrument] if instrument else [])):
+                if not rows:
+                    continue
+                for callback in list(self.listeners.get(table, [])):
+                    try:
+                        callback(table, 'update' if table == 'instrument' else 'insert', rows)
+                    except Exception:
+                        self.logger.exception('Listener failed.')
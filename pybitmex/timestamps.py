@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+from dateutil.parser import parse
+
+
+# Parsing of BitMEX timestamps, such as '2019-03-25T07:10:34.290Z'.
+#
+# BitMEX always sends this fixed format, which is parsed by slicing instead of with the generic
+# dateutil parser. Anything else falls back to dateutil. Results are cached by the string,
+# so a timestamp shared by many rows, or read on every call of an accessor, is parsed once.
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+EPOCH_ORDINAL = EPOCH.toordinal()
+
+# Field the websocket client stores the epoch nanoseconds of a row's timestamp in, when asked to.
+NS_FIELD = 'timestampNs'
+
+
+def _fields(text):
+    '''(year, month, day, hour, minute, second, millisecond) of the fixed format, or None.'''
+    if len(text) == 24 and text[23] == 'Z' and text[10] == 'T' and text[19] == '.':
+        return (int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                int(text[11:13]), int(text[14:16]), int(text[17:19]), int(text[20:23]))
+    return None
+
+
+@lru_cache(maxsize=4096)
+def parse_timestamp(text):
+    '''Parse a timestamp into an aware UTC datetime.'''
+    fields = _fields(text)
+    if fields is None:
+        return parse(text).astimezone(timezone.utc)
+    year, month, day, hour, minute, second, millisecond = fields
+    return datetime(year, month, day, hour, minute, second, millisecond * 1000, tzinfo=timezone.utc)
+
+
+@lru_cache(maxsize=4096)
+def timestamp_ns(text):
+    '''Parse a timestamp into nanoseconds since the epoch.'''
+    fields = _fields(text)
+    if fields is None:
+        return (parse_timestamp(text) - EPOCH) // timedelta(microseconds=1) * 1000
+    year, month, day, hour, minute, second, millisecond = fields
+    days = datetime(year, month, day).toordinal() - EPOCH_ORDINAL
+    return (((days * 24 + hour) * 60 + minute) * 60 + second) * 1000000000 + millisecond * 1000000
+
+
+@lru_cache(maxsize=4096)
+def datetime_from_ns(ns):
+    '''Aware UTC datetime of nanoseconds since the epoch, to the microsecond.'''
+    return EPOCH + timedelta(microseconds=ns // 1000)
+
+
+def timestamp_seconds(text):
+    '''Parse a timestamp into seconds since the epoch.'''
+    return timestamp_ns(text) / 1e9
+
+
+def row_seconds(row):
+    '''Seconds since the epoch of the timestamp of a row, using the nanoseconds stored at ingest if any.'''
+    ns = row.get(NS_FIELD)
+    if ns is not None:
+        return ns / 1e9
+    return timestamp_ns(row['timestamp']) / 1e9
+
+
+def row_datetime(row):
+    '''Aware UTC datetime of the timestamp of a row, using the nanoseconds stored at ingest if any.'''
+    ns = row.get(NS_FIELD)
+    if ns is not None:
+        return datetime_from_ns(ns)
+    return parse_timestamp(row['timestamp'])
@@ -0,0 +1,198 @@
+import logging
+import threading
+import time
+from collections import deque
+
+
+# Local position, margin and PnL of one symbol, kept up to date from the execution stream.
+#
+# Values are in the settlement currency units of the instrument (satoshis for XBt), following BitMEX:
+#   value(qty, price) = multiplier * qty / price   for inverse contracts (e.g. XBTUSD, multiplier -100000000)
+#   value(qty, price) = multiplier * qty * price   otherwise
+# cost is the value of the open position at entry, so unrealised PnL is value(qty, markPrice) - cost.
+# Now and then the tracker is reconciled against the position and margin tables to correct any drift.
+class PositionTracker:
+
+    # Don't remember more execIDs than this amount.
+    MAX_EXEC_IDS = 1000
+
+    def __init__(self, symbol, is_inverse=True, multiplier=-100000000,
+                 reconcile_interval_seconds=60, settle_seconds=1.0, clock=None):
+        '''
+        reconcile_interval_seconds: how often to accept the position and margin tables as the truth.
+        settle_seconds: don't reconcile until this long after the last fill,
+        so that the position table has caught up with it.
+        clock returns the current time in epoch seconds, e.g. a simulated one in backtests. Defaults to time.time.
+        '''
+        self.logger = logging.getLogger(__name__)
+
+        self.symbol = symbol
+        self.is_inverse = is_inverse
+        self.multiplier = multiplier
+        self.reconcile_interval_seconds = reconcile_interval_seconds
+        self.settle_seconds = settle_seconds
+        self.clock = clock if clock is not None else time.time
+
+        self.lock = threading.Lock()
+        self.current_qty = 0
+        self.cost = 0.0
+        # Since the tracker started.
+        self.realised_pnl = 0.0
+        self.commission = 0.0
+        self.fill_count = 0
+        # Since the last reconciliation, to estimate the wallet balance.
+        self.realised_since_reconcile = 0.0
+        self.wallet_balance = None
+        self.mark_price = None
+
+        # Returns the current (position row, margin row), for periodic reconciliation.
+        self.reconcile_source = None
+
+        self.exec_ids = set()
+        self.exec_id_queue = deque()
+        self.last_fill_time = 0.0
+        self.last_reconcile_time = 0.0
+
+    def value(self, qty, price):
+        if self.is_inverse:
+            return self.multiplier * qty / price
+        return self.multiplier * qty * price
+
+    def on_message(self, table, action, rows):
+        '''Listener for the execution, position, margin and instrument tables.'''
+        if table == 'execution':
+            if action != 'partial':
+                # The partial is history. The reconciliation gives us the starting point.
+                for row in rows:
+                    self.apply_execution(row)
+        elif table in ('instrument', 'position'):
+            for row in rows:
+                if row.get('symbol') == self.symbol and row.get('markPrice') is not None:
+                    self.mark_price = float(row['markPrice'])
+
+        if self.reconcile_source is not None and self.is_reconcile_due():
+            self.reconcile(*self.reconcile_source())
+
+    def apply_execution(self, row):
+        if row.get('symbol') != self.symbol:
+            return
+        exec_id = row.get('execID')
+        if exec_id is not None:
+            if exec_id in self.exec_ids:
+                return
+            self.exec_ids.add(exec_id)
+            self.exec_id_queue.append(exec_id)
+            if PositionTracker.MAX_EXEC_IDS < len(self.exec_id_queue):
+                self.exec_ids.discard(self.exec_id_queue.popleft())
+
+        exec_type = row.get('execType')
+        commission = float(row.get('execComm') or 0)
+        if exec_type == 'Trade' and row.get('lastQty'):
+            self.apply_fill(row['side'], int(row['lastQty']), float(row['lastPx']), commission)
+        elif exec_type == 'Funding':
+            with self.lock:
+                self.commission += commission
+                self.realised_since_reconcile -= commission
+
+    def apply_fill(self, side, qty, price, commission=0.0):
+        '''Apply a fill of qty contracts. commission is positive when paid, negative for rebates.'''
+        signed_qty = qty if side == 'Buy' else -qty
+        with self.lock:
+            if self.current_qty == 0 or (0 < self.current_qty) == (0 < signed_qty):
+                self.cost += self.value(signed_qty, price)
+                self.current_qty += signed_qty
+            else:
+                # Reduce the position, at its average cost, and open the rest on the other side.
+                closed_qty = min(abs(signed_qty), abs(self.current_qty))
+                if self.current_qty < 0:
+                    closed_qty = -closed_qty
+                closed_cost = self.cost * closed_qty / self.current_qty
+                realised = self.value(closed_qty, price) - closed_cost
+                self.realised_pnl += realised
+                self.realised_since_reconcile += realised
+                self.cost -= closed_cost
+                self.current_qty -= closed_qty
+
+                remaining_qty = signed_qty + closed_qty
+                if remaining_qty:
+                    self.cost = self.value(remaining_qty, price)
+                    self.current_qty = remaining_qty
+                elif self.current_qty == 0:
+                    self.cost = 0.0
+            self.commission += commission
+            self.realised_since_reconcile -= commission
+            self.fill_count += 1
+            self.last_fill_time = self.clock()
+
+    def avg_entry_price(self):
+        with self.lock:
+            if self.current_qty == 0 or self.cost == 0:
+                return None
+            if self.is_inverse:
+                return self.multiplier * self.current_qty / self.cost
+            return self.cost / (self.multiplier * self.current_qty)
+
+    def unrealised_pnl(self, mark_price=None):
+        mark_price = mark_price if mark_price is not None else self.mark_price
+        with self.lock:
+            if self.current_qty == 0 or mark_price is None:
+                return 0.0
+            return self.value(self.current_qty, mark_price) - self.cost
+
+    def wallet_balance_estimate(self):
+        '''Wallet balance of the last reconciliation, plus what was realised since. None before reconciling.'''
+        with self.lock:
+            if self.wallet_balance is None:
+                return None
+            return self.wallet_balance + self.realised_since_reconcile
+
+    def is_reconcile_due(self):
+        now = self.clock()
+        return self.reconcile_interval_seconds <= now - self.last_reconcile_time and \
+            self.settle_seconds <= now - self.last_fill_time
+
+    def reconcile(self, position=None, margin=None):
+        '''
+        Take position size and entry from a position row, and the wallet balance from a margin row.
+        Returns the drift of the position size we had locally.
+        '''
+        drift = 0
+        with self.lock:
+            if position is not None:
+                qty = int(position.get('currentQty') or 0)
+                # The first reconciliation seeds the position, which nothing has tracked yet.
+                seeding = self.last_reconcile_time == 0.0 and self.fill_count == 0
+                drift = 0 if seeding else self.current_qty - qty
+                avg_entry_price = position.get('avgEntryPrice')
+                if qty and avg_entry_price:
+                    self.cost = self.value(qty, float(avg_entry_price))
+                elif not qty:
+                    self.cost = 0.0
+                self.current_qty = qty
+                if position.get('markPrice') is not None:
+                    self.mark_price = float(position['markPrice'])
+            if margin is not None and margin.get('walletBalance') is not None:
+                self.wallet_balance = float(margin['walletBalance'])
+                self.realised_since_reconcile = 0.0
+            self.last_reconcile_time = self.clock()
+        if drift:
+            self.logger.warning("Local position of %s drifted by %d contracts." % (self.symbol, drift))
+        return drift
+
+    def to_dict(self):
+        avg_entry_price = self.avg_entry_price()
+        unrealised_pnl = self.unrealised_pnl()
+        wallet_balance = self.wallet_balance_estimate()
+        with self.lock:
+            return {
+                'symbol': self.symbol,
+                'currentQty': self.current_qty,
+                'cost': self.cost,
+                'avgEntryPrice': avg_entry_price,
+                'markPrice': self.mark_price,
+                'realisedPnl': self.realised_pnl,
+                'commission': self.commission,
+                'unrealisedPnl': unrealised_pnl,
+                'walletBalance': wallet_balance,
+                'fillCount': self.fill_count
+            }
@@ -0,0 +1,213 @@
+import logging
+import threading
+import time
+from time import sleep
+
+import websocket
+
+
+# Transports carry the frames of BitMEXWebSocketClient.
+#
+# A transport connects in a background thread and calls back with each text frame received.
+# BitMEXWebSocketClient only uses connect(), connected, send(), close() and stats,
+# so the underlying websocket library can be swapped at construction.
+
+
+class TransportStats:
+
+    '''
+    Counts frames and payload bytes received, in total and over the last full second.
+    Wire bytes are what was read from the socket, which differ from payload bytes when frames are compressed.
+    '''
+
+    def __init__(self):
+        self.started = time.time()
+        self.frames = 0
+        self.bytes = 0
+        self.wire_bytes = 0
+        self.current_second = int(self.started)
+        self.current_frames = 0
+        self.current_bytes = 0
+        self.current_wire_bytes = 0
+        self.last_second_frames = 0
+        self.last_second_bytes = 0
+        self.last_second_wire_bytes = 0
+
+    def record(self, message, wire_size=None):
+        '''
+        Count a received message, of size 0 if it was passed on parsed.
+        wire_size defaults to the size of the message, for uncompressed frames,
+        and is 0 when the transport counts wire bytes itself with record_wire.
+        '''
+        size = len(message) if isinstance(message, str) else 0
+        self.__roll()
+        self.current_frames += 1
+        self.current_bytes += size
+        self.frames += 1
+        self.bytes += size
+        if wire_size is None:
+            self.record_wire(size)
+        elif wire_size:
+            self.record_wire(wire_size)
+
+    def record_wire(self, size):
+        '''Count bytes read from the socket.'''
+        self.__roll()
+        self.current_wire_bytes += size
+        self.wire_bytes += size
+
+    def __roll(self):
+        now = int(time.time())
+        if now != self.current_second:
+            # The rates of the previous second, or zero if nothing came in during it.
+            if now == self.current_second + 1:
+                self.last_second_frames = self.current_frames
+                self.last_second_bytes = self.current_bytes
+                self.last_second_wire_bytes = self.current_wire_bytes
+            else:
+                self.last_second_frames = 0
+                self.last_second_bytes = 0
+                self.last_second_wire_bytes = 0
+            self.current_second = now
+            self.current_frames = 0
+            self.current_bytes = 0
+            self.current_wire_bytes = 0
+
+    def to_dict(self):
+        elapsed = max(time.time() - self.started, 1e-9)
+        return {
+            'frames': self.frames,
+            'bytes': self.bytes,
+            'wireBytes': self.wire_bytes,
+            'framesPerSecond': self.last_second_frames,
+            'bytesPerSecond': self.last_second_bytes,
+            'wireBytesPerSecond': self.last_second_wire_bytes,
+            'averageFramesPerSecond': self.frames / elapsed,
+            'averageBytesPerSecond': self.bytes / elapsed,
+            'averageWireBytesPerSecond': self.wire_bytes / elapsed
+        }
+
+
+class WebSocketAppTransport:
+
+    '''Transport on websocket-client. Frames are not compressed.'''
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self.stats = TransportStats()
+        self.ws = None
+        self.thread = None
+
+    @property
+    def connected(self):
+        return self.ws is not None and self.ws.sock is not None and self.ws.sock.connected
+
+    def connect(self, url, header, on_message, on_open, on_close, on_error):
+        '''Start connecting in a thread. Callbacks take no websocket argument.'''
+        def handle_message(_ws, message):
+            self.stats.record(message)
+            on_message(message)
+
+        self.ws = websocket.WebSocketApp(url,
+                                         on_message=handle_message,
+                                         on_close=lambda _ws, *args: on_close(),
+                                         on_open=lambda _ws: on_open(),
+                                         on_error=lambda _ws, error: on_error(error),
+                                         header=header)
+
+        self.thread = threading.Thread(target=lambda: self.ws.run_forever())
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, text):
+        self.ws.send(text)
+
+    def close(self):
+        if self.ws is not None:
+            self.ws.close()
+
+
+class DeflateTransport:
+
+    '''
+    Transport on the websockets library, negotiating permessage-deflate.
+    The websockets package is an optional dependency, imported on connect.
+    Byte counts are of decompressed payloads, wire byte counts of what was read from the socket.
+    '''
+
+    def __init__(self, max_queue=None):
+        self.logger = logging.getLogger(__name__)
+        self.stats = TransportStats()
+        self.max_queue = max_queue
+        self.connection = None
+        self.closing = False
+        self.thread = None
+
+    @property
+    def connected(self):
+        return self.connection is not None
+
+    def connect(self, url, header, on_message, on_open, on_close, on_error):
+        '''Start connecting in a thread. Callbacks take no websocket argument.'''
+        from websockets.sync.client import connect, ClientConnection
+
+        stats = self.stats
+
+        class CountingConnection(ClientConnection):
+            '''Counts the bytes read from the socket, before decompression.'''
+
+            def __init__(self, sock, protocol, **kwargs):
+                receive_data = protocol.receive_data
+
+                def count_and_receive(data):
+                    stats.record_wire(len(data))
+                    receive_data(data)
+
+                protocol.receive_data = count_and_receive
+                super().__init__(sock, protocol, **kwargs)
+
+        # "name: value" strings, as websocket-client takes them.
+        headers = [tuple(part.strip() for part in h.split(':', 1)) for h in header]
+        options = {'additional_headers': headers, 'compression': 'deflate', 'max_size': None,
+                   'create_connection': CountingConnection}
+        if self.max_queue is not None:
+            options['max_queue'] = self.max_queue
+
+        def run():
+            try:
+                with connect(url, **options) as connection:
+                    self.connection = connection
+                    on_open()
+                    for message in connection:
+                        self.stats.record(message, wire_size=0)
+                        on_message(message)
+            except Exception as e:
+                if not self.closing:
+                    on_error(e)
+            finally:
+                self.connection = None
+                on_close()
+
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, text):
+        self.connection.send(text)
+
+    def close(self):
+        self.closing = True
+        connection = self.connection
+        if connection is not None:
+            connection.close()
+
+
+def wait_for_connection(transport, timeout_seconds=5):
+    '''Wait until the transport has connected. Returns False on timeout.'''
+    waited = 0.0
+    while not transport.connected:
+        if timeout_seconds <= waited:
+            return False
+        sleep(0.1)
+        waited += 0.1
+    return True
@@ -1,5 +1,4 @@
 import math
-import threading
 import traceback
 
 from time import sleep
@@ -10,6 +9,19 @@ import urllib
 import websocket
 
 from pybitmex.auth import expiration_time, generate_signature
+from pybitmex.cache import ViewCache
+from pybitmex.ingest import IngestQueue
+from pybitmex.orderbook import DenseOrderBook
+from pybitmex.projection import Projection
+from pybitmex.timestamps import NS_FIELD, timestamp_ns
+from pybitmex.transport import WebSocketAppTransport, wait_for_connection
+
+
+# Tables anybody can subscribe to, and tables that need authentication.
+PUBLIC_TABLES = ["instrument", "orderBookL2", "orderBookL2_25", "orderBook10", "quote", "trade"]
+PRIVATE_TABLES = ["execution", "margin", "order", "position"]
+# From the deepest to the shallowest.
+ORDER_BOOK_TABLES = ["orderBookL2", "orderBookL2_25", "orderBook10"]
 
 
 # Naive implementation of connecting to BitMEX websocket for streaming real time data.
@@ -25,8 +37,22 @@ class BitMEXWebSocketClient:
     # Don't grow a table larger than this amount. Helps cap memory usage.
     MAX_TABLE_LEN = 200
 
-    def __init__(self, endpoint, symbol, api_key=None, api_secret=None, subscriptions=None, expiration_seconds=3600):
-        '''Connect to the websocket and initialize data stores.'''
+    def __init__(self, endpoint, symbol, api_key=None, api_secret=None, subscriptions=None, expiration_seconds=3600,
+                 batched_ingest=True, ingest_queue_size=10000, dense_order_book=False,
+                 projections=None, compact_rows=False, transport=None, clock=None,
+                 parse_timestamps=False):
+        '''
+        Connect to the websocket and initialize data stores.
+        With batched_ingest, frames are applied on a separate thread and bursts of updates are merged.
+        Otherwise each frame is applied right away on the websocket thread.
+        With dense_order_book, orderBookL2 is stored in a DenseOrderBook instead of a list of dicts.
+        projections maps table names to the columns to keep of their rows (see projection.Projection).
+        With compact_rows, the projected rows are stored as __slots__ objects instead of dicts.
+        transport carries the frames (see transport.py). Defaults to a WebSocketAppTransport.
+        clock returns the current time as a UTC datetime, e.g. a simulated one in backtests. Defaults to the system clock.
+        With parse_timestamps, rows stored as dicts get the epoch nanoseconds of their timestamp in timestampNs,
+        parsed once at ingest.
+        '''
         self.logger = logging.getLogger(__name__)
         self.logger.debug("Initializing WebSocket.")
 
@@ -42,9 +68,17 @@ class BitMEXWebSocketClient:
 
         self.api_key = api_key
         self.api_secret = api_secret
+        self.use_dense_order_book = dense_order_book
+        self.columns = projections or {}
+        self.compact_rows = compact_rows
+        self.parse_timestamps = parse_timestamps
+        self.projections = {}
+        self.transport = transport if transport is not None else WebSocketAppTransport()
+        if clock is not None:
+            self._now = clock
 
         if subscriptions is not None:
-            self.subscription_list = subscriptions
+            self.subscription_list = list(subscriptions)
         else:
             self.subscription_list =\
                 ["execution", "instrument", "margin", "order", "orderBookL2", "position", "quote", "trade"]
@@ -52,8 +86,25 @@ class BitMEXWebSocketClient:
         self.updates = {}
         self.data = {}
         self.keys = {}
+        # Bumped each time a message of the table is applied.
+        self.versions = {}
+        self.view_cache = ViewCache()
+        self.listeners = {}
         self.exited = False
 
+        # Deltas received before the partial of their table, kept until it arrives.
+        self.pending_partials = set(self.subscription_list)
+        self.early_messages = {}
+        # Order book table we're switching to, and the one we switched to.
+        self.order_book_target = None
+        self.order_book_table = None
+
+        if batched_ingest:
+            self.ingest = IngestQueue(self.__apply_message, self.keys, max_size=ingest_queue_size)
+            self.ingest.start()
+        else:
+            self.ingest = None
+
         # We can subscribe right in the connection querystring, so let's build that.
         # Subscribe to all pertinent endpoints
         ws_uri = self.__get_url()
@@ -73,7 +124,9 @@ class BitMEXWebSocketClient:
     def exit(self):
         '''Call this to exit - will close websocket.'''
         self.exited = True
-        self.ws.close()
+        self.transport.close()
+        if self.ingest:
+            self.ingest.stop()
 
     def get_instrument(self):
         '''Get the raw instrument data for this symbol.'''
@@ -84,6 +137,12 @@ class BitMEXWebSocketClient:
 
     def get_ticker(self):
         '''Return a ticker object. Generated from quote and trade.'''
+        versions = self.versions
+        version_key = (versions.get('quote'), versions.get('trade'), versions.get('instrument'),
+                       self.data['instrument'][0].get('tickLog'))
+        return self.view_cache.get('ticker', version_key, self._compute_ticker)
+
+    def _compute_ticker(self):
         last_quote = self.data['quote'][-1]
         last_trade = self.data['trade'][-1]
         ticker = {
@@ -95,7 +154,7 @@ class BitMEXWebSocketClient:
 
         # The instrument has a tickSize. Use it to round values.
         instrument = self.data['instrument'][0]
-        if 'tickLog' in instrument:
+        if instrument.get('tickLog') is not None:
             return {k: round(float(v or 0), instrument['tickLog']) for k, v in ticker.items()}
         else:
             return {}
@@ -112,6 +171,8 @@ class BitMEXWebSocketClient:
         return self.data['execution']
 
     def get_order_book_table_name(self):
+        if self.order_book_table in self.data:
+            return self.order_book_table
         if 'orderBookL2' in self.data:
             return 'orderBookL2'
         elif 'orderBookL2_25' in self.data:
@@ -122,7 +183,17 @@ class BitMEXWebSocketClient:
     def market_depth(self):
         '''Get market depth (orderbook). Returns all levels.'''
         table_name = self.get_order_book_table_name()
-        return self.data[table_name]
+        book = self.data[table_name]
+        if isinstance(book, DenseOrderBook):
+            return book.to_rows()
+        return book
+
+    def dense_order_book(self):
+        '''Get the DenseOrderBook holding orderBookL2, or None if the book is stored as rows.'''
+        book = self.data.get(self.get_order_book_table_name())
+        if isinstance(book, DenseOrderBook):
+            return book
+        return None
 
     def open_orders(self, clOrdIDPrefix):
         '''Get all your open orders.'''
@@ -134,6 +205,64 @@ class BitMEXWebSocketClient:
         '''Get recent trades.'''
         return self.data['trade']
 
+    def subscribe(self, tables):
+        '''Subscribe to more tables without reconnecting. Their data arrives asynchronously.'''
+        new_tables = [t for t in tables if t not in self.subscription_list]
+        if not new_tables:
+            return
+        self.subscription_list += new_tables
+        self.pending_partials.update(new_tables)
+        self.__send_command('subscribe', self.__get_topics(new_tables))
+
+    def unsubscribe(self, tables):
+        '''Unsubscribe from tables without reconnecting, and drop their data.'''
+        old_tables = [t for t in tables if t in self.subscription_list]
+        if not old_tables:
+            return
+        for table in old_tables:
+            self.subscription_list.remove(table)
+            self.pending_partials.discard(table)
+            self.early_messages.pop(table, None)
+            self.projections.pop(table, None)
+            self.keys.pop(table, None)
+            self.data.pop(table, None)
+            self.versions[table] = self.versions.get(table, 0) + 1
+        self.__send_command('unsubscribe', self.__get_topics(old_tables))
+
+    def switch_order_book(self, table_name):
+        '''
+        Switch to another order book table, e.g. from orderBookL2 to orderBook10 to save bandwidth.
+        The current table is kept, and get_order_book_table_name() keeps returning it,
+        until the partial of the new table has arrived.
+        '''
+        if table_name not in ORDER_BOOK_TABLES:
+            raise ValueError('Not an order book table: %s' % table_name)
+        if table_name in self.data and table_name not in self.pending_partials:
+            self.order_book_target = None
+            self.__complete_order_book_switch(table_name)
+        else:
+            self.order_book_target = table_name
+            self.subscribe([table_name])
+
+    def transport_stats(self):
+        '''Get frames and bytes received, in total and per second.'''
+        return self.transport.stats.to_dict()
+
+    def ingest_stats(self):
+        '''Get queue depth and counters of the ingest pipeline. Empty without batched ingest.'''
+        if self.ingest:
+            return self.ingest.stats()
+        return {}
+
+    def add_listener(self, table, callback):
+        '''Call callback(table, action, rows) each time a message of the table has been applied.'''
+        self.listeners.setdefault(table, []).append(callback)
+
+    def remove_listener(self, table, callback):
+        callbacks = self.listeners.get(table, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
     #
     # End Public Methods
     #
@@ -142,24 +271,16 @@ class BitMEXWebSocketClient:
         '''Connect to the websocket in a thread.'''
         self.logger.debug("Starting thread")
 
-        self.ws = websocket.WebSocketApp(wsURL,
-                                         on_message=self.__on_message,
-                                         on_close=self.__on_close,
-                                         on_open=self.__on_open,
-                                         on_error=self.__on_error,
-                                         header=self.__get_auth())
-
-        self.wst = threading.Thread(target=lambda: self.ws.run_forever())
-        self.wst.daemon = True
-        self.wst.start()
+        self.transport.connect(wsURL,
+                               on_message=self.__on_message,
+                               on_close=self.__on_close,
+                               on_open=self.__on_open,
+                               on_error=self.__on_error,
+                               header=self.__get_auth())
         self.logger.debug("Started thread")
 
         # Wait for connect before continuing
-        conn_timeout = 5
-        while not self.ws.sock or not self.ws.sock.connected and conn_timeout:
-            sleep(1)
-            conn_timeout -= 1
-        if not conn_timeout:
+        if not wait_for_connection(self.transport, 5):
             self.logger.error("Couldn't connect to WS! Exiting.")
             self.exit()
             raise websocket.WebSocketTimeoutException('Couldn\'t connect to WS! Exiting.')
@@ -180,24 +301,22 @@ class BitMEXWebSocketClient:
             self.logger.info("Not authenticating.")
             return []
 
-    def __get_url(self):
-        import copy
+    def __get_topics(self, tables):
+        '''Most subscription topics are scoped by the symbol we're listening to.'''
+        subscriptions_per_symbol = [t for t in tables if t != "margin"]
+        generic_subscriptions = [t for t in tables if t == "margin"]
 
+        subscriptions = [sub + ':' + self.symbol for sub in subscriptions_per_symbol]
+        subscriptions += generic_subscriptions
+        return subscriptions
+
+    def __get_url(self):
         '''
         Generate a connection URL. We can define subscriptions right in the querystring.
-        Most subscription topics are scoped by the symbol we're listening to.
         '''
 
         # You can sub to orderBookL2 for all levels, or orderBook10 for top 10 levels & save bandwidth
-        subscriptions_per_symbol = copy.copy(self.subscription_list)
-        if "margin" in subscriptions_per_symbol:
-            subscriptions_per_symbol.remove("margin")
-            generic_subscriptions = ["margin"]
-        else:
-            generic_subscriptions = []
-
-        subscriptions = [sub + ':' + self.symbol for sub in subscriptions_per_symbol]
-        subscriptions += generic_subscriptions
+        subscriptions = self.__get_topics(self.subscription_list)
 
         uri_parts = list(urllib.parse.urlparse(self.endpoint))
         uri_parts[0] = uri_parts[0].replace('http', 'ws')
@@ -215,12 +334,19 @@ class BitMEXWebSocketClient:
         '''Send a raw command.'''
         if args is None:
             args = []
-        self.ws.send(json.dumps({"op": command, "args": args}))
+        self.transport.send(json.dumps({"op": command, "args": args}))
 
     def __on_message(self, message):
-        '''Handler for parsing WS messages.'''
-        message = json.loads(message)
-        self.logger.debug(json.dumps(message))
+        '''Handler for WS messages. Transports may also pass messages they have already parsed.'''
+        if self.ingest:
+            self.ingest.put(message)
+        else:
+            self.__apply_message(message if isinstance(message, dict) else json.loads(message))
+
+    def __apply_message(self, message):
+        '''Handler for parsed WS messages.'''
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(json.dumps(message))
 
         table = message.get('table')
         action = message.get('action')
@@ -230,25 +356,45 @@ class BitMEXWebSocketClient:
         try:
             if 'subscribe' in message:
                 self.logger.debug("Subscribed to %s." % message['subscribe'])
+            elif 'unsubscribe' in message:
+                self.logger.debug("Unsubscribed from %s." % message['unsubscribe'])
             elif action:
 
-                if table not in self.data:
-                    self.data[table] = []
-
+                if table not in self.subscription_list:
+                    # Still in flight when we unsubscribed.
+                    return
+                if table in self.pending_partials:
+                    if action == 'partial':
+                        self.pending_partials.discard(table)
+                    else:
+                        self.early_messages.setdefault(table, []).append(message)
+                        return
+
+                if table not in self.data or action == 'partial':
+                    self.data[table] = self.__new_table(table)
+
+                if isinstance(self.data[table], DenseOrderBook):
+                    if action == 'partial':
+                        self.keys[table] = message['keys']
+                    self.data[table].apply(action, message['data'])
                 # There are four possible actions from the WS:
                 # 'partial' - full table image
                 # 'insert'  - new row
                 # 'update'  - update row
                 # 'delete'  - delete row
-                if action == 'partial':
+                elif action == 'partial':
                     self.logger.debug("%s: partial" % table)
-                    self.data[table] += message['data']
                     # Keys are communicated on partials to let you know how to uniquely identify
                     # an item. We use it for updates.
                     self.keys[table] = message['keys']
+                    if table in self.columns:
+                        self.projections[table] =\
+                            Projection(table, self.columns[table], message['keys'], self.compact_rows)
+                    # A partial replaces the table, e.g. after a resubscription.
+                    self.data[table] = self.__stamp(self.__project(table, message['data']))
                 elif action == 'insert':
-                    self.logger.debug('%s: inserting %s' % (table, message['data']))
-                    self.data[table] += message['data']
+                    self.logger.debug('%s: inserting %s', table, message['data'])
+                    self.data[table] += self.__stamp(self.__project(table, message['data']))
 
                     # Limit the max length of the table to avoid excessive memory usage.
                     # Don't trim orders because we'll lose valuable state if we do.
@@ -256,27 +402,98 @@ class BitMEXWebSocketClient:
                         self.data[table] = self.data[table][BitMEXWebSocketClient.MAX_TABLE_LEN // 2:]
 
                 elif action == 'update':
-                    self.logger.debug('%s: updating %s' % (table, message['data']))
+                    self.logger.debug('%s: updating %s', table, message['data'])
                     # Locate the item in the collection and update it.
+                    projection = self.projections.get(table)
                     for updateData in message['data']:
                         item = find_by_keys(self.keys[table], self.data[table], updateData)
                         if not item:
-                            return  # No item found to update. Could happen before push
+                            # No item found to update. Could happen before push
+                            self.logger.debug('%s: no item to update for %s', table, updateData)
+                            continue
+                        updateData = projection.project_update(updateData) if projection else updateData
+                        if self.parse_timestamps and updateData.get('timestamp') is not None:
+                            updateData[NS_FIELD] = timestamp_ns(updateData['timestamp'])
                         item.update(updateData)
                         # Remove cancelled / filled orders
                         if table == 'order' and not order_leaves_quantity(item):
                             self.data[table].remove(item)
                 elif action == 'delete':
-                    self.logger.debug('%s: deleting %s' % (table, message['data']))
+                    self.logger.debug('%s: deleting %s', table, message['data'])
                     # Locate the item in the collection and remove it.
                     for deleteData in message['data']:
                         item = find_by_keys(self.keys[table], self.data[table], deleteData)
+                        if not item:
+                            self.logger.debug('%s: no item to delete for %s', table, deleteData)
+                            continue
                         self.data[table].remove(item)
                 else:
                     raise Exception("Unknown action: %s" % action)
+
+                self.versions[table] = self.versions.get(table, 0) + 1
+                for callback in self.listeners.get(table, []):
+                    # A failing listener must not keep the others, or the partial handling, from running.
+                    try:
+                        callback(table, action, message['data'])
+                    except Exception:
+                        self.logger.error(traceback.format_exc())
+
+                if action == 'partial':
+                    self.__on_partial(table, message['data'])
         except:
             self.logger.error(traceback.format_exc())
 
+    def __on_partial(self, table, partial_rows):
+        # Replay what arrived before the partial, less what the partial already covers:
+        # rows timestamped no later than its newest row, and for orderBook10, whose messages are
+        # whole snapshots, everything. Without timestamps, inserts of rows we already have are skipped.
+        early_messages = self.early_messages.pop(table, [])
+        if table == 'orderBook10':
+            early_messages = []
+        partial_times = [timestamp_ns(row['timestamp']) for row in partial_rows
+                         if isinstance(row, dict) and row.get('timestamp') is not None]
+        partial_time = max(partial_times) if partial_times else None
+        for message in early_messages:
+            rows = message['data']
+            if partial_time is not None:
+                rows = [row for row in rows if
+                        row.get('timestamp') is None or partial_time < timestamp_ns(row['timestamp'])]
+            if message['action'] == 'insert' and not isinstance(self.data[table], DenseOrderBook):
+                keys = self.keys[table]
+                rows = [row for row in rows if
+                        (find_by_keys(keys, self.data[table], row) is None if keys else row not in self.data[table])]
+            if not rows:
+                continue
+            self.__apply_message(dict(message, data=rows))
+        self.__finish_partial(table)
+
+    def __finish_partial(self, table):
+        if table == self.order_book_target:
+            self.order_book_target = None
+            self.__complete_order_book_switch(table)
+
+    def __complete_order_book_switch(self, table):
+        self.order_book_table = table
+        self.unsubscribe([t for t in ORDER_BOOK_TABLES if t != table and t in self.subscription_list])
+
+    def __project(self, table, rows):
+        projection = self.projections.get(table)
+        if projection is None:
+            return rows
+        return [projection.project(row) for row in rows]
+
+    def __stamp(self, rows):
+        if self.parse_timestamps:
+            for row in rows:
+                if isinstance(row, dict) and row.get('timestamp') is not None:
+                    row[NS_FIELD] = timestamp_ns(row['timestamp'])
+        return rows
+
+    def __new_table(self, table):
+        if table == 'orderBookL2' and self.use_dense_order_book:
+            return DenseOrderBook(self.symbol)
+        return []
+
     def __on_error(self, error):
         '''Called on fatal websocket errors. We exit on these.'''
         if not self.exited:
@@ -43,6 +43,10 @@ setup(
 
     install_requires=_requirements(),
     tests_require=_test_requirements(),
+    extras_require={
+        # transport.DeflateTransport, for ws_compression.
+        'deflate': ['websockets>=11'],
+    },
 
     author=author,
     author_email=author_email,
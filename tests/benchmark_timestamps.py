@@ -0,0 +1,43 @@
+'''
+Times the timestamp parsers of pybitmex.timestamps against dateutil. From the repository root:
+
+    PYTHONPATH=. python tests/benchmark_timestamps.py
+'''
+import timeit
+from datetime import datetime, timedelta, timezone
+
+from dateutil.parser import parse
+
+from pybitmex.timestamps import parse_timestamp, timestamp_ns
+
+# As many distinct timestamps as the caches hold.
+COUNT = 4096
+
+
+def main():
+    start = datetime(2019, 3, 25, tzinfo=timezone.utc)
+    texts = [(start + timedelta(milliseconds=7 * i)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+             for i in range(COUNT)]
+
+    def parse_all(function, clear_cache=False):
+        def run():
+            if clear_cache:
+                function.cache_clear()
+            for text in texts:
+                function(text)
+        return run
+
+    cases = [
+        ('dateutil.parser.parse', parse_all(parse)),
+        ('parse_timestamp, uncached', parse_all(parse_timestamp, clear_cache=True)),
+        ('parse_timestamp, cached', parse_all(parse_timestamp)),
+        ('timestamp_ns, uncached', parse_all(timestamp_ns, clear_cache=True)),
+        ('timestamp_ns, cached', parse_all(timestamp_ns)),
+    ]
+    for name, run in cases:
+        seconds = min(timeit.repeat(run, number=1, repeat=5))
+        print('%-28s %8.2f us per timestamp' % (name, seconds / len(texts) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
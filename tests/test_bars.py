@@ -0,0 +1,103 @@
+import threading
+from datetime import datetime, timezone
+
+import pytest
+
+from pybitmex.bars import BarAggregator
+
+
+def utc(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc)
+
+
+def test_tick_bars_close_when_full():
+    aggregator = BarAggregator(BarAggregator.TICK, 3)
+    for i, price in enumerate([10.0, 12.0, 9.0, 11.0]):
+        aggregator.add_trade(100.0 + i, 'Buy' if i % 2 else 'Sell', price, 2)
+
+    [bar] = aggregator.bars()
+    assert (bar.open, bar.high, bar.low, bar.close) == (10.0, 12.0, 9.0, 9.0)
+    assert (bar.volume, bar.buy_volume, bar.sell_volume, bar.count) == (6, 2, 4, 3)
+    assert (bar.start, bar.end) == (utc(100.0), utc(102.0))
+    assert bar.vwap == pytest.approx((10.0 + 12.0 + 9.0) / 3)
+    assert aggregator.current_bar().open == 11.0
+
+
+def test_volume_bars_overshoot_rather_than_split():
+    aggregator = BarAggregator(BarAggregator.VOLUME, 100)
+    aggregator.add_trade(1.0, 'Buy', 10.0, 60)
+    aggregator.add_trade(2.0, 'Buy', 10.0, 70)
+    assert [bar.volume for bar in aggregator.bars()] == [130]
+    assert aggregator.current_bar() is None
+
+
+def test_time_bars_close_on_the_next_interval_and_fill_gaps():
+    aggregator = BarAggregator(BarAggregator.TIME, 60)
+    aggregator.add_trade(65.0, 'Buy', 10.0, 1)
+    aggregator.add_trade(70.0, 'Sell', 11.0, 1)
+    aggregator.add_trade(250.0, 'Buy', 12.0, 1)
+
+    bars = aggregator.bars()
+    assert [(bar.start, bar.end) for bar in bars] == [(utc(60), utc(120)), (utc(120), utc(180)), (utc(180), utc(240))]
+    assert [bar.count for bar in bars] == [2, 0, 0]
+    # Empty bars stay at the last close.
+    assert [bar.close for bar in bars] == [11.0, 11.0, 11.0]
+
+
+def test_flush_until_closes_time_bars_without_trades():
+    closed = []
+    aggregator = BarAggregator(BarAggregator.TIME, 60, on_bar_closed=closed.append)
+    aggregator.add_trade(65.0, 'Buy', 10.0, 1)
+    aggregator.flush_until(119.0)
+    assert closed == []
+    aggregator.flush_until(245.0)
+    assert [(bar.start, bar.count) for bar in closed] == [(utc(60), 1), (utc(120), 0), (utc(180), 0)]
+    assert aggregator.current_bar() is None
+
+
+def test_max_bars_keeps_the_latest():
+    aggregator = BarAggregator(BarAggregator.TICK, 1, max_bars=10)
+    for i in range(25):
+        aggregator.add_trade(float(i), 'Buy', float(i), 1)
+    assert len(aggregator) <= 10
+    assert aggregator.bars()[-1].close == 24.0
+    assert [bar.close for bar in aggregator.bars(3)] == [22.0, 23.0, 24.0]
+
+
+def test_on_bar_closed_may_read_the_bars():
+    seen = []
+    aggregator = BarAggregator(BarAggregator.TICK, 1, on_bar_closed=lambda bar: seen.append(len(aggregator.bars())))
+    aggregator.add_trade(1.0, 'Buy', 10.0, 1)
+    aggregator.add_trade(2.0, 'Buy', 10.0, 1)
+    assert seen == [1, 2]
+
+
+def test_bars_are_consistent_while_trades_come_in():
+    # Every field of bar i is derived from i, so a bar mixing fields of different bars shows.
+    aggregator = BarAggregator(BarAggregator.TICK, 2, max_bars=50)
+    done = threading.Event()
+    errors = []
+
+    def feed():
+        for i in range(40000):
+            aggregator.add_trade(float(i // 2), 'Buy', float(i // 2), i // 2 + 1)
+        done.set()
+
+    def read():
+        try:
+            while not done.is_set():
+                for bar in aggregator.bars():
+                    n = bar.open
+                    assert (bar.close, bar.start.timestamp(), bar.volume) == (n, n, 2 * (n + 1))
+                aggregator.current_bar()
+                aggregator.flush_until(0.0)
+        except Exception as e:
+            errors.append(e)
+            done.set()
+
+    threads = [threading.Thread(target=feed)] + [threading.Thread(target=read) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
@@ -0,0 +1,135 @@
+import threading
+
+import pytest
+
+from pybitmex.coalesce import OrderRequestCoalescer
+from pybitmex.rest import RestClientError
+
+
+class FakeRestClient:
+
+    '''Answers like BitMEX. Fails whole requests holding an order priced at error_price, with error_code.'''
+
+    def __init__(self, error_code=None, error_price=-1):
+        self.error_code = error_code
+        self.error_price = error_price
+        self.lock = threading.Lock()
+        self.calls = []
+        self.next_id = 0
+
+    def new_client_order_id(self):
+        with self.lock:
+            self.next_id += 1
+            return 'c%d' % self.next_id
+
+    def place_orders(self, orders, post_only=True, max_retries=None):
+        self.calls.append(('place', [o['clOrdID'] for o in orders]))
+        if self.error_code is not None and any(o['price'] == self.error_price for o in orders):
+            raise RestClientError('Rejected', self.error_code)
+        return [dict(o, orderID='o-' + o['clOrdID'], ordStatus='New') for o in orders]
+
+    def cancel_orders(self, order_id_list, max_retries=None):
+        self.calls.append(('cancel', list(order_id_list)))
+        return [{'orderID': i, 'ordStatus': 'Canceled'} for i in order_id_list]
+
+    def cancel_orders_by_client_order_id(self, client_order_id_list, max_retries=None):
+        self.calls.append(('cancel_by_client_order_id', list(client_order_id_list)))
+        return [{'clOrdID': i, 'ordStatus': 'Canceled'} for i in client_order_id_list]
+
+
+def submit_concurrently(coalescer, calls):
+    '''Run each call(coalescer) on its own thread. Returns their results, or the errors they raised.'''
+    results = [None] * len(calls)
+    started = threading.Barrier(len(calls))
+
+    def run(i):
+        started.wait()
+        try:
+            results[i] = calls[i](coalescer)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(calls))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def place(price, client_order_id):
+    return lambda coalescer: coalescer.place_orders([{'clOrdID': client_order_id, 'side': 'Buy', 'orderQty': 1,
+                                                      'price': price}])
+
+
+@pytest.fixture
+def make_coalescer():
+    coalescers = []
+
+    def make(rest_client, **kwargs):
+        coalescer = OrderRequestCoalescer(rest_client, window_seconds=0.2, **kwargs)
+        coalescers.append(coalescer)
+        return coalescer
+
+    yield make
+    for coalescer in coalescers:
+        coalescer.exit()
+
+
+def test_each_caller_gets_its_own_rows(make_coalescer):
+    rest_client = FakeRestClient()
+    coalescer = make_coalescer(rest_client)
+    results = submit_concurrently(coalescer, [place(100 + i, 'a%d' % i) for i in range(4)])
+
+    assert [[row['orderID'] for row in rows] for rows in results] == [['o-a%d' % i] for i in range(4)]
+    assert len(rest_client.calls) == 1
+    assert coalescer.stats() == {'requests': 4, 'batches': 1}
+
+
+def test_cancels_are_split_by_order_id_and_client_order_id(make_coalescer):
+    rest_client = FakeRestClient()
+    coalescer = make_coalescer(rest_client)
+    results = submit_concurrently(coalescer, [
+        lambda c: c.cancel_orders(['x', 'y']),
+        lambda c: c.cancel_orders(['z']),
+        lambda c: c.cancel_orders_by_client_order_id(['k']),
+    ])
+
+    assert [[row.get('orderID') or row.get('clOrdID') for row in rows] for rows in results] == [['x', 'y'], ['z'], ['k']]
+    assert sorted(kind for kind, _ in rest_client.calls) == ['cancel', 'cancel_by_client_order_id']
+
+
+def test_batches_do_not_split_a_callers_orders(make_coalescer):
+    rest_client = FakeRestClient()
+    coalescer = make_coalescer(rest_client, max_batch_size=3)
+    results = submit_concurrently(coalescer, [
+        lambda c, i=i: c.place_orders([{'clOrdID': 'b%d-%d' % (i, j), 'side': 'Buy', 'orderQty': 1, 'price': 100}
+                                       for j in range(2)])
+        for i in range(3)
+    ])
+
+    assert all(len(rows) == 2 for rows in results)
+    # 2 + 2 orders would exceed 3, so each caller's pair goes in its own request.
+    assert sorted(sorted(ids) for _, ids in rest_client.calls) == [['b%d-0' % i, 'b%d-1' % i] for i in range(3)]
+
+
+def test_validation_error_only_fails_the_caller_with_the_invalid_order(make_coalescer):
+    rest_client = FakeRestClient(error_code=400)
+    coalescer = make_coalescer(rest_client)
+    results = submit_concurrently(coalescer, [place(-1 if i == 2 else 100, 'v%d' % i) for i in range(4)])
+
+    assert isinstance(results[2], RestClientError)
+    assert [[row['orderID'] for row in results[i]] for i in (0, 1, 3)] == [['o-v0'], ['o-v1'], ['o-v3']]
+    # The batch, then each request on its own.
+    assert len(rest_client.calls) == 5
+    assert coalescer.stats()['requests'] == 4
+
+
+@pytest.mark.parametrize('error_code', [401, 403, 429, 503])
+def test_other_errors_go_to_every_caller_without_resending(make_coalescer, error_code):
+    rest_client = FakeRestClient(error_code=error_code)
+    coalescer = make_coalescer(rest_client)
+    results = submit_concurrently(coalescer, [place(-1 if i == 0 else 100, 'r%d' % i) for i in range(4)])
+
+    assert all(isinstance(result, RestClientError) and result.error_code == error_code for result in results)
+    assert len(rest_client.calls) == 1
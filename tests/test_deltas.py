@@ -0,0 +1,125 @@
+import pytest
+
+from pybitmex.deltas import BookDeltaLog, follow_order_book, unfollow_order_book
+
+
+def level(level_id, side, price=None, size=None):
+    row = {'symbol': 'XBTUSD', 'id': level_id, 'side': side}
+    if price is not None:
+        row['price'] = price
+    if size is not None:
+        row['size'] = size
+    return row
+
+
+def as_set(changes):
+    return {(c['side'], c['price'], c['size']) for c in changes}
+
+
+@pytest.fixture
+def log():
+    log = BookDeltaLog()
+    log.on_message('orderBookL2', 'partial', [level(1, 'Sell', 101.0, 10), level(2, 'Buy', 100.0, 20)])
+    return log
+
+
+def test_first_read_is_a_snapshot(log):
+    cursor, changes, is_snapshot = log.changes_since()
+    assert is_snapshot
+    assert as_set(changes) == {('Sell', 101.0, 10), ('Buy', 100.0, 20)}
+    assert log.changes_since(cursor) == (cursor, [], False)
+
+
+def test_changes_since_the_cursor_keep_the_latest_of_each_level(log):
+    cursor = log.changes_since()[0]
+    log.on_message('orderBookL2', 'insert', [level(3, 'Buy', 99.0, 5)])
+    middle = log.changes_since(cursor)[0]
+    log.on_message('orderBookL2', 'update', [level(2, 'Buy', size=25), level(2, 'Buy', size=30)])
+    log.on_message('orderBookL2', 'delete', [level(1, 'Sell')])
+
+    new_cursor, changes, is_snapshot = log.changes_since(cursor)
+    assert not is_snapshot
+    assert as_set(changes) == {('Buy', 99.0, 5), ('Buy', 100.0, 30), ('Sell', 101.0, 0)}
+    assert as_set(log.changes_since(middle)[1]) == {('Buy', 100.0, 30), ('Sell', 101.0, 0)}
+    assert log.changes_since(new_cursor)[1] == []
+
+
+def test_updates_of_unknown_levels_and_other_tables_are_ignored(log):
+    cursor = log.changes_since()[0]
+    log.on_message('orderBookL2', 'update', [level(9, 'Buy', size=1)])
+    log.on_message('orderBookL2_25', 'insert', [level(3, 'Buy', 99.0, 5)])
+    assert log.changes_since(cursor) == (cursor, [], False)
+
+
+@pytest.mark.parametrize('cursor_offset', [-1, 1])
+def test_cursor_out_of_range_gets_a_snapshot(cursor_offset):
+    log = BookDeltaLog(max_changes=4)
+    log.on_message('orderBookL2', 'partial', [level(1, 'Buy', 100.0, 1)])
+    cursor = log.changes_since()[0]
+    for size in range(2, 7):
+        log.on_message('orderBookL2', 'update', [level(1, 'Buy', size=size)])
+    # Trimmed down to the later half.
+    assert len(log.changes) == 2
+
+    new_cursor, changes, is_snapshot = log.changes_since(cursor if cursor_offset < 0 else log.sequence + 1)
+    assert is_snapshot
+    assert new_cursor == log.sequence
+    assert as_set(changes) == {('Buy', 100.0, 6)}
+
+
+def test_cursor_at_the_oldest_kept_change_is_not_a_snapshot():
+    log = BookDeltaLog(max_changes=4)
+    log.on_message('orderBookL2', 'partial', [level(1, 'Buy', 100.0, 1)])
+    for size in range(2, 7):
+        log.on_message('orderBookL2', 'update', [level(1, 'Buy', size=size)])
+    assert log.changes_since(log.base_sequence)[1:] == ([{'side': 'Buy', 'price': 100.0, 'size': 6}], False)
+
+
+def test_partial_forces_a_snapshot(log):
+    cursor = log.changes_since()[0]
+    log.on_message('orderBookL2_25', 'partial', [level(5, 'Sell', 102.0, 7)])
+    cursor, changes, is_snapshot = log.changes_since(cursor)
+    assert is_snapshot
+    assert as_set(changes) == {('Sell', 102.0, 7)}
+
+    # Now following orderBookL2_25.
+    log.on_message('orderBookL2_25', 'update', [level(5, 'Sell', size=8)])
+    assert log.changes_since(cursor)[1:] == ([{'side': 'Sell', 'price': 102.0, 'size': 8}], False)
+
+
+def test_order_book_10_is_diffed_against_the_previous_top():
+    log = BookDeltaLog()
+    log.on_message('orderBook10', 'partial', [{'bids': [[100.0, 20], [99.5, 5]], 'asks': [[100.5, 10]]}])
+    cursor = log.changes_since()[0]
+    log.on_message('orderBook10', 'update', [{'bids': [[100.0, 25], [99.0, 3]], 'asks': [[100.5, 10]]}])
+    assert as_set(log.changes_since(cursor)[1]) == {('Buy', 100.0, 25), ('Buy', 99.5, 0), ('Buy', 99.0, 3)}
+
+
+class FakeClient:
+
+    def __init__(self, rows):
+        self.listeners = {}
+        self.data = {'orderBookL2': rows}
+
+    def add_listener(self, table, listener):
+        self.listeners.setdefault(table, []).append(listener)
+
+    def remove_listener(self, table, listener):
+        self.listeners[table].remove(listener)
+
+    def get_order_book_table_name(self):
+        return 'orderBookL2'
+
+    def market_depth(self):
+        return self.data['orderBookL2']
+
+
+def test_follow_order_book_starts_from_the_current_book():
+    client = FakeClient([level(1, 'Sell', 101.0, 10)])
+    log = BookDeltaLog()
+    follow_order_book(client, log)
+    assert as_set(log.changes_since()[1]) == {('Sell', 101.0, 10)}
+    assert log.on_message in client.listeners['orderBookL2']
+
+    unfollow_order_book(client, log)
+    assert all(not listeners for listeners in client.listeners.values())
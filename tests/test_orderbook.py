@@ -0,0 +1,109 @@
+import random
+
+import pytest
+
+from pybitmex.orderbook import DenseOrderBook
+
+# XBTUSD: price = (88e8 - id) * 0.01
+BASE = 8800000000
+PRICE_PER_ID = 0.01
+
+
+def level(price, side='Buy', size=1):
+    return {'symbol': 'XBTUSD', 'id': int(round(BASE - price / PRICE_PER_ID)), 'side': side, 'size': size,
+            'price': price}
+
+
+def book_of(levels):
+    book = DenseOrderBook('XBTUSD')
+    book.partial(levels)
+    return book
+
+
+def test_partial_sorts_levels_best_first():
+    book = book_of([level(5001.0, 'Sell', 3), level(5002.0, 'Sell', 4), level(5000.0, 'Buy', 5),
+                    level(4999.0, 'Buy', 6)])
+    assert book.bids() == [{'price': 5000.0, 'size': 5}, {'price': 4999.0, 'size': 6}]
+    assert book.asks() == [{'price': 5001.0, 'size': 3}, {'price': 5002.0, 'size': 4}]
+    assert book.best_bid() == {'price': 5000.0, 'size': 5}
+    assert book.best_ask() == {'price': 5001.0, 'size': 3}
+    assert len(book) == 4
+
+
+def test_update_and_delete():
+    bid, ask = level(5000.0, 'Buy', 5), level(5001.0, 'Sell', 3)
+    book = book_of([bid, ask])
+    book.update([{'id': bid['id'], 'size': 50}])
+    book.delete([{'id': ask['id']}])
+    assert book.bids() == [{'price': 5000.0, 'size': 50}]
+    assert book.asks() == []
+    assert len(book) == 1
+
+
+def test_liquidity_counts_levels_at_or_better_than_the_limit():
+    book = book_of([level(5000.0, 'Buy', 5), level(4999.5, 'Buy', 6), level(4999.0, 'Buy', 7),
+                    level(5001.0, 'Sell', 3), level(5002.0, 'Sell', 4)])
+    assert book.liquidity('Buy', 4999.5) == 11
+    assert book.liquidity('Sell', 5001.0) == 3
+    assert book.liquidity('Sell', 6000.0) == 7
+
+
+@pytest.mark.parametrize('partial', [[], [level(5000.0, 'Buy', 5)]])
+def test_prices_come_from_the_levels_until_two_are_known(partial):
+    book = book_of(partial)
+    book.insert([level(5001.5, 'Sell', 2)])
+    book.insert([level(4998.5, 'Buy', 3)])
+    assert book.asks() == [{'price': 5001.5, 'size': 2}]
+    assert book.bids()[-1] == {'price': 4998.5, 'size': 3}
+    assert book.calibrated
+
+
+def test_finer_level_inserted_into_an_emptied_book():
+    book = book_of([level(4999.0, 'Buy'), level(5001.0, 'Sell')])
+    book.delete([level(4999.0), level(5001.0)])
+    book.insert([level(5000.5, 'Buy', 2)])
+    assert book.stride != 0
+    assert book.bids() == [{'price': 5000.5, 'size': 2}]
+
+    # The book keeps working once a second level arrives.
+    book.insert([level(5001.5, 'Sell', 3)])
+    book.update([{'id': level(5000.5)['id'], 'size': 7}])
+    assert book.bids() == [{'price': 5000.5, 'size': 7}]
+    assert book.asks() == [{'price': 5001.5, 'size': 3}]
+
+
+def test_finer_level_lays_the_grid_out_again():
+    book = book_of([level(4999.0, 'Buy', 1), level(5001.0, 'Sell', 2)])
+    book.insert([level(5000.5, 'Sell', 3), level(4999.5, 'Buy', 4)])
+    assert book.bids() == [{'price': 4999.5, 'size': 4}, {'price': 4999.0, 'size': 1}]
+    assert book.asks() == [{'price': 5000.5, 'size': 3}, {'price': 5001.0, 'size': 2}]
+
+
+def test_random_changes_match_a_dict_book():
+    rng = random.Random(7)
+    prices = [5000.0 + 0.5 * i for i in range(-40, 40)]
+    expected = {}
+    book = DenseOrderBook('XBTUSD', max_slots=64)
+    book.partial([])
+    for _ in range(5000):
+        price = rng.choice(prices)
+        row = level(price, 'Buy' if price < 5000.0 else 'Sell', rng.randint(1, 100))
+        if row['id'] in expected and rng.random() < 0.5:
+            book.delete([row])
+            del expected[row['id']]
+        elif row['id'] in expected:
+            book.update([{'id': row['id'], 'size': row['size']}])
+            expected[row['id']]['size'] = row['size']
+        else:
+            book.insert([row])
+            expected[row['id']] = row
+        assert len(book) == len(expected)
+
+    def levels(side):
+        rows = sorted((r for r in expected.values() if r['side'] == side), key=lambda r: r['price'],
+                      reverse=(side == 'Buy'))
+        return [{'price': r['price'], 'size': r['size']} for r in rows]
+
+    assert book.bids() == levels('Buy')
+    assert book.asks() == levels('Sell')
+    assert [(r['id'], r['size']) for r in book.to_rows()] == sorted((i, r['size']) for i, r in expected.items())
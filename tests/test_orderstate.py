@@ -0,0 +1,64 @@
+from pybitmex.orderstate import OrderStateBook
+
+
+class Clock:
+
+    def __init__(self):
+        self.seconds = 1000.0
+
+    def __call__(self):
+        return self.seconds
+
+
+def order(client_order_id, price=100.0, side='Buy', **fields):
+    return dict({'clOrdID': client_order_id, 'side': side, 'orderQty': 10, 'price': price}, **fields)
+
+
+def row(order_id, client_order_id, status='New'):
+    return {'orderID': order_id, 'clOrdID': client_order_id, 'side': 'Buy', 'orderQty': 10, 'price': 100.0,
+            'leavesQty': 10, 'ordStatus': status}
+
+
+def test_pending_orders_show_until_the_order_table_confirms_them():
+    book = OrderStateBook()
+    book.add_pending_orders([order('a')])
+    assert [(o['orderID'], o['clOrdID']) for o in book.merge([])] == [(None, 'a')]
+
+    book.on_orders_placed([{'clOrdID': 'a', 'orderID': 'A', 'ordStatus': 'New'}])
+    assert [o['orderID'] for o in book.merge([])] == ['A']
+
+    book.on_message('order', 'insert', [row('A', 'a')])
+    assert book.merge([row('A', 'a')]) == [row('A', 'a')]
+
+
+def test_market_orders_are_not_pending():
+    book = OrderStateBook()
+    book.add_pending_orders([order('m', price=None), order('n', ordType='Market'),
+                             order('s', price=None, ordType='Stop', stopPx=90.0)])
+    assert [o['clOrdID'] for o in book.merge([])] == ['s']
+
+
+def test_pending_cancels_hide_orders_until_closed():
+    book = OrderStateBook()
+    rows = [row('A', 'a'), row('B', 'b')]
+    book.add_pending_cancels(['A'])
+    assert [o['orderID'] for o in book.merge(rows)] == ['B']
+
+    book.on_message('order', 'update', [row('A', 'a', status='Canceled')])
+    assert book.pending_cancels == {}
+
+
+def test_pending_state_expires_on_the_clock():
+    clock = Clock()
+    book = OrderStateBook(pending_timeout_seconds=10, clock=clock)
+    book.add_pending_orders([order('a')])
+    book.add_pending_cancels(['B'])
+    version = book.version
+
+    clock.seconds += 5
+    book.expire()
+    assert len(book.merge([])) == 1 and book.version == version
+
+    clock.seconds += 6
+    book.expire()
+    assert book.merge([]) == [] and book.pending_cancels == {} and version < book.version
@@ -0,0 +1,74 @@
+import pytest
+
+from pybitmex.projection import Projection, make_row_class
+from pybitmex.ws import BitMEXWebSocketClient
+
+INSTRUMENT = {'symbol': 'XBTUSD', 'state': 'Open', 'tickSize': 0.5, 'markPrice': 5000.1, 'isInverse': True,
+              'multiplier': -100000000, 'lotSize': 1, 'fundingRate': 0.0001}
+TRADE = {'timestamp': '2019-03-25T07:00:00.000Z', 'symbol': 'XBTUSD', 'side': 'Buy', 'size': 10, 'price': 5000.5,
+         'trdMatchID': 'a', 'tickDirection': 'PlusTick', 'grossValue': 199980, 'homeNotional': 0.002}
+QUOTE = {'timestamp': '2019-03-25T07:00:00.000Z', 'symbol': 'XBTUSD', 'bidSize': 5, 'bidPrice': 5000.0,
+         'askPrice': 5000.5, 'askSize': 7}
+
+
+class PartialsTransport:
+
+    '''Sends the partials of the tables subscribed on connect, and nothing else.'''
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.connected = False
+
+    def connect(self, url, header, on_message, on_open, on_close, on_error):
+        self.connected = True
+        on_open()
+        for table, row in self.rows.items():
+            on_message({'table': table, 'action': 'partial', 'keys': ['symbol'] if table == 'instrument' else [],
+                        'data': [dict(row)]})
+
+    def send(self, text):
+        pass
+
+    def close(self):
+        self.connected = False
+
+
+@pytest.fixture(params=[False, True], ids=['dicts', 'compact'])
+def client(request):
+    # Keep none of the columns beyond the required ones.
+    client = BitMEXWebSocketClient(
+        'https://testnet.bitmex.com/api/v1/', 'XBTUSD', subscriptions=['instrument', 'trade', 'quote'],
+        projections={'instrument': [], 'trade': [], 'quote': []}, compact_rows=request.param,
+        batched_ingest=False, transport=PartialsTransport({'instrument': INSTRUMENT, 'trade': TRADE, 'quote': QUOTE})
+    )
+    yield client
+    client.exit()
+
+
+def test_projection_keeps_the_accessor_columns(client):
+    trade = client.recent_trades()[0]
+    assert (trade['timestamp'], trade['side'], trade['size'], trade['price'], trade['trdMatchID']) == \
+        ('2019-03-25T07:00:00.000Z', 'Buy', 10, 5000.5, 'a')
+    assert trade.get('grossValue') is None
+    assert client.data['instrument'][0].get('fundingRate') is None
+
+
+def test_ticker_and_tick_log_with_projected_instrument(client):
+    assert client.get_instrument()['tickLog'] == 0
+    assert client.get_ticker() == {'last': 5000.0, 'buy': 5000.0, 'sell': 5000.0, 'mid': 5000.0}
+
+
+def test_projection_adds_keys_and_required_columns():
+    projection = Projection('trade', ['homeNotional'], keys=['trdMatchID'])
+    assert set(projection.project(TRADE)) == {'timestamp', 'symbol', 'side', 'size', 'price', 'trdMatchID',
+                                              'homeNotional'}
+
+
+def test_compact_rows_read_like_dicts_and_reject_unknown_columns():
+    row = make_row_class('trade', ['price', 'size'])({'price': 1.5, 'size': 2, 'side': 'Buy'})
+    assert (row['price'], row.get('size'), row.get('side'), 'price' in row) == (1.5, 2, None, True)
+    row['size'] = 3
+    row.update({'size': 4, 'side': 'Sell'})
+    assert dict(row.items()) == {'price': 1.5, 'size': 4}
+    with pytest.raises(KeyError):
+        row['side'] = 'Sell'
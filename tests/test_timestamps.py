@@ -0,0 +1,69 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from dateutil.parser import parse
+
+from pybitmex.timestamps import (
+    NS_FIELD, parse_timestamp, timestamp_ns, timestamp_seconds, datetime_from_ns, row_seconds, row_datetime
+)
+
+
+def _random_timestamps(count, seed=1):
+    rng = random.Random(seed)
+    start = datetime(2014, 11, 22, tzinfo=timezone.utc)
+    for _ in range(count):
+        dt = start + timedelta(milliseconds=rng.randrange(0, 20 * 365 * 24 * 3600 * 1000))
+        yield dt.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+@pytest.mark.parametrize('text', [
+    '2019-03-25T07:10:34.290Z',
+    '1970-01-01T00:00:00.000Z',
+    '2020-02-29T23:59:59.999Z',
+    '2038-01-19T03:14:08.001Z',
+])
+def test_fixed_format_matches_dateutil(text):
+    expected = parse(text)
+    assert parse_timestamp(text) == expected
+    assert parse_timestamp(text).tzinfo == timezone.utc
+    assert timestamp_ns(text) == round(expected.timestamp() * 1000) * 1000000
+
+
+def test_random_timestamps_match_dateutil():
+    for text in _random_timestamps(5000):
+        expected = parse(text)
+        assert parse_timestamp(text) == expected, text
+        assert timestamp_ns(text) == round(expected.timestamp() * 1000) * 1000000, text
+        assert timestamp_seconds(text) == pytest.approx(expected.timestamp(), abs=1e-6)
+
+
+@pytest.mark.parametrize('text', [
+    '2019-03-25T07:10:34Z',
+    '2019-03-25T07:10:34.290123Z',
+    '2019-03-25T16:10:34.290+09:00',
+    '2019-03-25 07:10:34',
+])
+def test_other_formats_fall_back_to_dateutil(text):
+    expected = parse(text)
+    if expected.tzinfo is None:
+        # dateutil reads a naive time as local time.
+        expected = expected.astimezone(timezone.utc)
+    assert parse_timestamp(text) == expected
+    assert parse_timestamp(text).tzinfo == timezone.utc
+    assert timestamp_ns(text) == (expected - datetime(1970, 1, 1, tzinfo=timezone.utc)) // timedelta(microseconds=1) * 1000
+
+
+def test_datetime_from_ns_round_trips():
+    for text in _random_timestamps(1000, seed=2):
+        assert datetime_from_ns(timestamp_ns(text)) == parse_timestamp(text)
+
+
+def test_rows_use_stored_nanoseconds():
+    text = '2019-03-25T07:10:34.290Z'
+    # A different time than the text, to tell where the result came from.
+    ns = timestamp_ns('2019-03-25T07:10:35.000Z')
+    assert row_datetime({'timestamp': text}) == parse_timestamp(text)
+    assert row_datetime({'timestamp': text, NS_FIELD: ns}) == datetime(2019, 3, 25, 7, 10, 35, tzinfo=timezone.utc)
+    assert row_seconds({'timestamp': text}) == timestamp_seconds(text)
+    assert row_seconds({'timestamp': text, NS_FIELD: ns}) == ns / 1e9
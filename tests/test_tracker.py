@@ -0,0 +1,111 @@
+import pytest
+
+from pybitmex.tracker import PositionTracker
+
+
+class Clock:
+
+    def __init__(self):
+        self.seconds = 1000.0
+
+    def __call__(self):
+        return self.seconds
+
+
+def execution(exec_id, side, qty, price, commission=0.0, exec_type='Trade', symbol='XBTUSD'):
+    return {'execID': exec_id, 'symbol': symbol, 'execType': exec_type, 'side': side, 'lastQty': qty,
+            'lastPx': price, 'execComm': commission}
+
+
+def test_inverse_average_entry_is_the_harmonic_mean():
+    tracker = PositionTracker('XBTUSD')
+    tracker.apply_fill('Buy', 100, 5000.0)
+    tracker.apply_fill('Buy', 100, 10000.0)
+    assert tracker.current_qty == 200
+    assert tracker.cost == pytest.approx(-3000000)
+    assert tracker.avg_entry_price() == pytest.approx(20000.0 / 3)
+
+
+def test_inverse_realised_and_unrealised_pnl():
+    tracker = PositionTracker('XBTUSD')
+    tracker.apply_fill('Buy', 100, 5000.0)
+    tracker.apply_fill('Buy', 100, 10000.0)
+    tracker.apply_fill('Sell', 100, 8000.0)
+    # 100 / 6666.67 - 100 / 8000 XBT
+    assert tracker.realised_pnl == pytest.approx(250000)
+    assert tracker.current_qty == 100
+    assert tracker.avg_entry_price() == pytest.approx(20000.0 / 3)
+    assert tracker.unrealised_pnl(10000.0) == pytest.approx(1500000 - 1000000)
+
+
+def test_fill_through_zero_opens_the_other_side_at_the_fill_price():
+    tracker = PositionTracker('XBTUSD')
+    tracker.apply_fill('Buy', 100, 5000.0)
+    tracker.apply_fill('Sell', 300, 4000.0)
+    assert tracker.current_qty == -200
+    assert tracker.avg_entry_price() == pytest.approx(4000.0)
+    assert tracker.realised_pnl == pytest.approx(100000000 * 100 / 5000.0 - 100000000 * 100 / 4000.0)
+
+    tracker.apply_fill('Buy', 200, 4000.0)
+    assert (tracker.current_qty, tracker.cost, tracker.avg_entry_price()) == (0, 0.0, None)
+
+
+def test_linear_contract():
+    tracker = PositionTracker('ETHUSD', is_inverse=False, multiplier=100)
+    tracker.apply_fill('Buy', 10, 200.0)
+    tracker.apply_fill('Buy', 10, 300.0)
+    assert tracker.avg_entry_price() == pytest.approx(250.0)
+    assert tracker.unrealised_pnl(260.0) == pytest.approx(100 * 20 * 10)
+    tracker.apply_fill('Sell', 20, 240.0)
+    assert tracker.realised_pnl == pytest.approx(-100 * 20 * 10)
+
+
+def test_executions_are_applied_once_with_commission_and_funding():
+    tracker = PositionTracker('XBTUSD')
+    tracker.on_message('execution', 'partial', [execution('old', 'Buy', 50, 5000.0)])
+    tracker.on_message('execution', 'insert', [execution('a', 'Buy', 100, 5000.0, commission=-500),
+                                               execution('a', 'Buy', 100, 5000.0, commission=-500),
+                                               execution('b', 'Buy', 100, 5000.0, symbol='ETHUSD'),
+                                               execution('f', None, 0, None, commission=300, exec_type='Funding')])
+    assert tracker.current_qty == 100
+    assert tracker.fill_count == 1
+    assert tracker.commission == pytest.approx(-200)
+
+
+def test_wallet_balance_estimate_adds_what_was_realised_since_reconciling():
+    tracker = PositionTracker('XBTUSD')
+    assert tracker.wallet_balance_estimate() is None
+    tracker.reconcile(None, {'walletBalance': 1000000})
+    tracker.apply_fill('Buy', 100, 5000.0, commission=100)
+    tracker.apply_fill('Sell', 100, 4000.0)
+    assert tracker.wallet_balance_estimate() == pytest.approx(1000000 - 500000 - 100)
+
+
+def test_reconcile_seeds_then_reports_drift():
+    tracker = PositionTracker('XBTUSD')
+    assert tracker.reconcile({'currentQty': 100, 'avgEntryPrice': 5000.0, 'markPrice': 5100.0}) == 0
+    assert (tracker.current_qty, tracker.avg_entry_price(), tracker.mark_price) == (100, pytest.approx(5000.0), 5100.0)
+
+    tracker.apply_fill('Buy', 10, 5000.0)
+    assert tracker.reconcile({'currentQty': 100, 'avgEntryPrice': 5000.0}) == 10
+    assert tracker.current_qty == 100
+
+
+def test_reconciles_when_due_and_settled_on_the_clock():
+    clock = Clock()
+    tracker = PositionTracker('XBTUSD', reconcile_interval_seconds=60, settle_seconds=1.0, clock=clock)
+    position = {'currentQty': 0}
+    tracker.reconcile_source = lambda: (position, None)
+    tracker.reconcile(position)
+
+    tracker.on_message('execution', 'insert', [execution('a', 'Buy', 100, 5000.0)])
+    position = {'currentQty': 100, 'avgEntryPrice': 5000.0}
+    clock.seconds += 30
+    tracker.on_message('position', 'update', [{'symbol': 'XBTUSD', 'markPrice': 5050.0}])
+    assert tracker.last_reconcile_time == 1000.0
+    assert tracker.mark_price == 5050.0
+
+    clock.seconds += 31
+    tracker.on_message('instrument', 'update', [{'symbol': 'XBTUSD', 'markPrice': 5060.0}])
+    assert tracker.last_reconcile_time == 1061.0
+    assert tracker.to_dict()['markPrice'] == 5060.0
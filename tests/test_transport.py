@@ -0,0 +1,68 @@
+import json
+import threading
+
+import pytest
+
+from pybitmex.transport import DeflateTransport, TransportStats, wait_for_connection
+
+serve = pytest.importorskip('websockets.sync.server').serve
+
+
+@pytest.fixture
+def compressing_server():
+    '''A local server that negotiates permessage-deflate and answers each message with rows of trades.'''
+    extensions = []
+
+    def handler(connection):
+        extensions.extend(type(e).__name__ for e in connection.protocol.extensions)
+        for message in connection:
+            rows = [{'symbol': 'XBTUSD', 'side': 'Buy', 'size': 100, 'price': 5000.0 + i} for i in range(200)]
+            connection.send(json.dumps({'table': 'trade', 'action': 'insert', 'data': rows, 'request': message}))
+
+    with serve(handler, '127.0.0.1', 0, compression='deflate') as server:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        host, port = server.socket.getsockname()[:2]
+        yield 'ws://%s:%d' % (host, port), extensions
+        server.shutdown()
+
+
+def test_deflate_transport_receives_compressed_frames(compressing_server):
+    url, extensions = compressing_server
+    received = []
+    done = threading.Event()
+
+    def on_message(message):
+        received.append(json.loads(message))
+        if len(received) == 3:
+            done.set()
+
+    transport = DeflateTransport()
+    transport.connect(url, [], on_message, lambda: None, lambda: None, lambda error: None)
+    try:
+        assert wait_for_connection(transport)
+        for i in range(3):
+            transport.send('request %d' % i)
+        assert done.wait(5)
+    finally:
+        transport.close()
+
+    assert extensions == ['PerMessageDeflate']
+    assert [m['request'] for m in received] == ['request 0', 'request 1', 'request 2']
+    assert len(received[0]['data']) == 200
+
+    stats = transport.stats.to_dict()
+    assert stats['frames'] == 3
+    assert stats['bytes'] == sum(len(json.dumps(m)) for m in received)
+    # Repetitive rows compress well.
+    assert 0 < stats['wireBytes'] < stats['bytes'] / 2
+
+
+def test_stats_count_payload_as_wire_bytes_by_default():
+    stats = TransportStats()
+    stats.record('abc')
+    stats.record('de', wire_size=0)
+    stats.record_wire(1)
+    assert stats.to_dict()['bytes'] == 5
+    assert stats.to_dict()['wireBytes'] == 4